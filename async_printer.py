@@ -0,0 +1,99 @@
+import asyncio
+import concurrent.futures
+from printer import Printer, transfer_buffer
+
+
+class AsyncPrinter:
+    # asyncio front end for Printer. All USB calls run on one worker thread, so they never block the event loop and
+    # never run concurrently. Jobs are sent in chunks: status polls get their turn in between, and cancelling a
+    # job stops it after the current chunk.
+
+    def __init__(self, vendor_id=None, product_id=None, printer=None, chunk_size=64 * 1024):
+        self._printer = printer if printer is not None else Printer(vendor_id, product_id)
+        self._chunk_size = chunk_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ppla-usb')
+        self._job_lock = None
+        self._poll_task = None
+        self._ready = None
+        self.status = None
+        # Last error of the status polling, which keeps going after one
+        self.status_error = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        self._job_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        await self._call(self._printer.open)
+
+    async def close(self):
+        try:
+            await self.stop_status_polling()
+        finally:
+            try:
+                await self._call(self._printer.close)
+            finally:
+                self._executor.shutdown()
+
+    async def get_device_id(self):
+        return await self._call(self._printer.get_device_id)
+
+    async def get_port_status(self):
+        return await self._call(self._printer.get_port_status)
+
+    async def soft_reset(self):
+        return await self._call(self._printer.soft_reset)
+
+    async def recv(self, length):
+        return await self._call(self._printer.recv, length)
+
+    async def send(self, data):
+        view = transfer_buffer(data)
+        offset = 0
+        async with self._job_lock:
+            while offset < len(view):
+                offset += await self._call(self._printer.send, view[offset:offset + self._chunk_size])
+        return offset
+
+    async def wait_ready(self):
+        await self._ready.wait()
+
+    def _update_status(self, status):
+        self.status = status
+        if status['select'] and not status['paper_empty'] and not status['error']:
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    async def _poll_status(self, interval):
+        while True:
+            try:
+                self._update_status(await self.get_port_status())
+                self.status_error = None
+            except Exception as e:
+                # e.g. a USB hiccup, the printer is not ready until it answers again
+                self.status_error = e
+                self._ready.clear()
+            await asyncio.sleep(interval)
+
+    def start_status_polling(self, interval=1.0):
+        if self._poll_task is None:
+            self._poll_task = asyncio.get_running_loop().create_task(self._poll_status(interval))
+        return self._poll_task
+
+    async def stop_status_polling(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
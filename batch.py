@@ -0,0 +1,40 @@
+import collections
+import concurrent.futures
+import itertools
+import os
+from stream import sink_writer
+
+
+def _render_chunk(render, specs):
+    return b''.join(bytes(render(spec)) for spec in specs)
+
+
+def render_batch(specs, render, workers=None, use_processes=True, chunk_size=32, max_pending=None):
+    # Renders label specs on a process (or thread) pool and yields the encoded data in the order of specs.
+    # render turns one spec into bytes and has to be picklable (a module level function) for processes. Specs are
+    # handed out chunk_size at a time, and at most max_pending chunks are in flight, which bounds memory use.
+    executor_class = concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * workers
+    with executor_class(max_workers=workers) as executor:
+        pending = collections.deque()
+        specs = iter(specs)
+        while True:
+            chunk = list(itertools.islice(specs, chunk_size))
+            if chunk:
+                pending.append(executor.submit(_render_chunk, render, chunk))
+            if pending and (len(pending) >= max_pending or not chunk):
+                yield pending.popleft().result()
+            elif not chunk:
+                return
+
+
+def print_batch(specs, render, sink, **kwargs):
+    # Renders the specs in parallel and writes the data to sink (a Printer, BackgroundWriter, file or socket) in order
+    write = sink_writer(sink)
+    size = 0
+    for data in render_batch(specs, render, **kwargs):
+        write(data)
+        size += len(data)
+    return size
@@ -0,0 +1,436 @@
+import argparse
+import datetime
+import json
+import platform
+import random
+import time
+import timeit
+import metrics
+from PIL import Image, ImageDraw
+from emulator import PrinterEmulator, diff_images
+from fakeusb import fake_printer
+from graphics import GraphicsCache
+from printer import TransferError
+from template import LabelTemplate
+from ppla import PPLA, Serial, ppla_hex, ppla_hex_reference, ppla_hex_compressed, ppla_binary, compression_ratio, encode_image
+
+
+def random_image(width, height, seed=0):
+    rng = random.Random(seed)
+    return Image.frombytes('L', (width, height), bytes(rng.getrandbits(8) for _ in range(width * height)))
+
+
+def label_image(width, height):
+    # Mostly white artwork with solid bars and a small noisy block, like a typical label logo
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width - 1, height // 10), fill=0)
+    draw.rectangle((width // 8, height // 3, width // 2, height // 2), fill=0)
+    image.paste(random_image(width // 4, height // 6), (width // 2, height * 2 // 3))
+    return image
+
+
+def sample_images():
+    images = [('tux.jpg', Image.open('tux.jpg'))]
+    images += [('label {}x{}'.format(width, height), label_image(width, height)) for width, height in [(400, 300), (812, 1200)]]
+    images += [('noise 400x300', random_image(400, 300))]
+    return images
+
+
+def best_of(func, repeat, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def bench_ppla_hex(repeat):
+    print('ppla_hex encoder')
+    print('{:>12} {:>14} {:>14} {:>9}'.format('size', 'reference [ms]', 'bulk [ms]', 'speedup'))
+    results = {}
+    for width, height in [(64, 64), (200, 100), (400, 300), (812, 600), (812, 1200)]:
+        image = random_image(width, height)
+        if ppla_hex(image) != ppla_hex_reference(image):
+            raise RuntimeError('ppla_hex output differs from reference for {}x{}'.format(width, height))
+        reference = best_of(lambda: ppla_hex_reference(image), repeat)
+        bulk = best_of(lambda: ppla_hex(image), repeat, number=10)
+        print('{:>12} {:>14.2f} {:>14.3f} {:>8.0f}x'.format(
+            '{}x{}'.format(width, height), reference * 1000, bulk * 1000, reference / bulk))
+        results['{}x{}'.format(width, height)] = {'reference_seconds': reference, 'bulk_seconds': bulk}
+    return results
+
+
+def bench_compression(repeat):
+    print('ppla_hex_compressed encoder')
+    print('{:>16} {:>12} {:>16} {:>9} {:>14}'.format('image', 'plain [B]', 'compressed [B]', 'ratio', 'encode [ms]'))
+    results = {}
+    for name, image in sample_images():
+        ratio = compression_ratio(image)
+        encode = best_of(lambda: ppla_hex_compressed(image), repeat, number=10)
+        print('{:>16} {:>12} {:>16} {:>8.2f}x {:>14.3f}'.format(
+            name, len(ppla_hex(image)), len(ppla_hex_compressed(image)), ratio, encode * 1000))
+        results[name] = {'ratio': ratio, 'encode_seconds': encode}
+    return results
+
+
+def bench_binary(repeat):
+    print('graphics bytes on the wire')
+    print('{:>16} {:>10} {:>12} {:>10} {:>10}'.format('image', 'hex [B]', 'hex comp [B]', 'bmp [B]', 'pcx [B]'))
+    results = {}
+    for name, image in sample_images():
+        sizes = {
+            'hex_bytes': len(ppla_hex(image)),
+            'hex_compressed_bytes': len(ppla_hex_compressed(image)),
+            'bmp_bytes': len(ppla_binary(image, 'bmp')),
+            'pcx_bytes': len(ppla_binary(image, 'pcx')),
+        }
+        print('{:>16} {hex_bytes:>10} {hex_compressed_bytes:>12} {bmp_bytes:>10} {pcx_bytes:>10}'.format(name, **sizes))
+        results[name] = sizes
+    return results
+
+
+def build_label(ppla, record):
+    ppla.enter_label_mode()
+    ppla.label_set_pixel_size()
+    ppla.label_text(10, 200, record['name'], font='asd-12')
+    ppla.label_text(10, 160, record['sku'], font='font-2', horizontal_scale=2, vertical_scale=2)
+    ppla.label_text(10, 120, record['price'], font='asd-16')
+    ppla.label_barcode(10, 10, record['sku'], barcode_type='code-128', height=80)
+    ppla.label_box(0, 0, 400, 250)
+    ppla.label_end_job()
+    return ppla
+
+
+def sample_records(count):
+    return [{'name': 'Item {}'.format(i), 'sku': 'SKU{:08d}'.format(i), 'price': '{}.{:02d}'.format(i % 100, i % 97)}
+            for i in range(count)]
+
+
+def bench_template(repeat):
+    records = sample_records(10000)
+    template = LabelTemplate()
+    template = build_label(template, {name: template.slot(name) for name in records[0]}).compile()
+
+    def builder():
+        ppla = PPLA()
+        for record in records:
+            build_label(ppla, record)
+        return bytes(ppla.get_bytes())
+
+    if builder() != template.render_batch(records):
+        raise RuntimeError('Template output differs from the PPLA builder')
+    print('label templates ({} labels)'.format(len(records)))
+    results = {}
+    for name, func in [('PPLA builder', builder), ('compiled template', lambda: template.render_batch(records))]:
+        results[name] = {'labels_per_second': len(records) / best_of(func, repeat)}
+        print('{:>20} {:>12.0f} labels/s'.format(name, results[name]['labels_per_second']))
+    return results
+
+
+def text_label(ppla, record):
+    ppla.enter_label_mode()
+    for i in range(12):
+        ppla.label_text(10, 20 * i, '{} line {}'.format(record['name'], i), font='font-2')
+    ppla.label_end_job()
+
+
+def barcode_label(ppla, record):
+    ppla.enter_label_mode()
+    for i in range(6):
+        ppla.label_barcode(10, 40 * i, record['sku'] + str(i), barcode_type='code-128', height=30)
+    ppla.label_end_job()
+
+
+def graphics_label(ppla, record, image=label_image(400, 200)):
+    ppla.download_graphics('ART', image=image, memory='ram')
+    ppla.enter_label_mode()
+    ppla.label_graphic(0, 0, 'ART')
+    ppla.label_text(10, 210, record['name'])
+    ppla.label_end_job()
+
+
+LABEL_KINDS = [('text', text_label, 2000), ('barcode', barcode_label, 2000), ('graphics', graphics_label, 50)]
+
+
+def bench_labels(repeat):
+    print('label encoding')
+    print('{:>10} {:>14} {:>16}'.format('label', 'labels/s', 'bytes/label'))
+    results = {}
+    for name, build, count in LABEL_KINDS:
+        records = sample_records(count)
+
+        def encode():
+            ppla = PPLA()
+            for record in records:
+                build(ppla, record)
+            return ppla.get_bytes()
+
+        results[name] = {'labels_per_second': count / best_of(encode, repeat), 'bytes_per_label': len(encode()) / count}
+        print('{:>10} {labels_per_second:>14.0f} {bytes_per_label:>16.0f}'.format(name, **results[name]))
+    return results
+
+
+def bench_fields(repeat):
+    print('field records')
+    print('{:>16} {:>14}'.format('api', 'fields/s'))
+    fields = []
+    for i in range(2000):
+        fields += [
+            {'type': 'text', 'x': 10, 'y': 20 * (i % 10), 'data': 'Item {}'.format(i), 'font': 'asd-12'},
+            {'type': 'barcode', 'x': 10, 'y': 40, 'data': 'SKU{:08d}'.format(i), 'height': 80},
+            {'type': 'box', 'x': 0, 'y': 0, 'width': 400, 'height': 250},
+            {'type': 'line', 'x': 0, 'y': 100, 'width': 400, 'height': 2},
+        ]
+
+    def single():
+        ppla = PPLA()
+        for field in fields:
+            field = dict(field)
+            getattr(ppla, 'label_' + field.pop('type'))(**field)
+        return ppla.get_bytes()
+
+    def bulk():
+        return PPLA().add_fields(fields).get_bytes()
+
+    if single() != bulk():
+        raise RuntimeError('add_fields output differs from the label_* methods')
+    results = {}
+    for name, func in [('label_* methods', single), ('add_fields', bulk)]:
+        results[name] = {'fields_per_second': len(fields) / best_of(func, repeat)}
+        print('{:>16} {fields_per_second:>14.0f}'.format(name, **results[name]))
+    return results
+
+
+def bench_metrics(repeat):
+    print('instrumentation overhead')
+    print('{:>10} {:>14}'.format('metrics', 'labels/s'))
+    records = sample_records(5000)
+
+    def encode():
+        ppla = PPLA()
+        for record in records:
+            build_label(ppla, record)
+
+    results = {}
+    for name, enable in [('off', False), ('on', True)]:
+        metrics.reset()
+        if enable:
+            metrics.enable()
+        try:
+            results[name] = {'labels_per_second': len(records) / best_of(encode, repeat)}
+        finally:
+            metrics.disable()
+        print('{:>10} {labels_per_second:>14.0f}'.format(name, **results[name]))
+    return results
+
+
+def bench_transport(repeat):
+    # Link time is simulated by the fake device: 1 MB/s with 1 ms overhead per bulk write call
+    print('USB transfer of 200 KB (simulated full speed link)')
+    print('{:>16} {:>12} {:>14} {:>12}'.format('transfer size', 'write calls', 'link [s]', 'KB/s'))
+    data = bytes(random_image(800, 250).tobytes())
+    results = {}
+    for name, transfer_size in [('wMaxPacketSize', 64), ('4 KiB', 4096), ('64 KiB', None)]:
+        printer = fake_printer()
+        printer._dev.keep_data = False
+        printer.send(data, transfer_size=transfer_size)
+        link = printer._dev.link_seconds
+        results[name] = {'write_calls': printer._dev.write_calls, 'link_seconds': link, 'bytes_per_second': len(data) / link}
+        print('{:>16} {write_calls:>12} {link_seconds:>14.3f} {:>12.0f}'.format(name, len(data) / link / 1000, **results[name]))
+    return results
+
+
+def bench_job(repeat):
+    # End to end: encode every label and send it to a fake printer. Throughput counts host time plus simulated link time.
+    print('end to end job throughput (simulated full speed link)')
+    print('{:>10} {:>10} {:>12} {:>12} {:>12}'.format('label', 'labels', 'encode [s]', 'link [s]', 'labels/s'))
+    results = {}
+    for name, build, count in LABEL_KINDS:
+        records = sample_records(count)
+        printer = fake_printer()
+        printer._dev.keep_data = False
+        start = time.perf_counter()
+        for record in records:
+            ppla = PPLA()
+            build(ppla, record)
+            printer.send(ppla.get_bytes())
+        host = time.perf_counter() - start
+        link = printer._dev.link_seconds
+        results[name] = {'host_seconds': host, 'link_seconds': link, 'labels_per_second': count / (host + link)}
+        print('{:>10} {:>10} {host_seconds:>12.3f} {link_seconds:>12.3f} {labels_per_second:>12.0f}'.format(name, count, **results[name]))
+    return results
+
+
+def bench_emulator(repeat):
+    # Host side throughput with the emulator as the sink, and a pixel diff of the graphics encodings
+    print('printer emulator')
+    print('{:>22} {:>12}'.format('mode', 'labels/s'))
+    records = sample_records(2000)
+    template = LabelTemplate()
+    template = build_label(template, {name: template.slot(name) for name in records[0]}).compile()
+    results = {}
+    for name, rasterize in [('parse only', False), ('parse and rasterize', True)]:
+        def run():
+            emulator = PrinterEmulator(rasterize=rasterize, keep_labels=0)
+            for data in template.render_many(records):
+                emulator.send(data)
+        results[name] = {'labels_per_second': len(records) / best_of(run, repeat)}
+        print('{:>22} {labels_per_second:>12.0f}'.format(name, **results[name]))
+
+    labels = {}
+    for name, download in [('hex', lambda ppla, image: ppla.download_graphics('ART', image=image)),
+                           ('hex compressed', lambda ppla, image: ppla.download_graphics('ART', image=image, compress=True)),
+                           ('bmp', lambda ppla, image: ppla.download_graphics_binary('ART', image=image, image_format='bmp')),
+                           ('pcx', lambda ppla, image: ppla.download_graphics_binary('ART', image=image, image_format='pcx'))]:
+        ppla = PPLA()
+        # Not a multiple of 8 wide, which all encodings have to cut the same way
+        download(ppla, label_image(403, 300))
+        ppla.enter_label_mode()
+        ppla.label_graphic(10, 10, 'ART')
+        ppla.label_end_job()
+        emulator = PrinterEmulator()
+        emulator.send(ppla.get_bytes())
+        labels[name] = emulator.labels[0]
+    for name, label in labels.items():
+        results[name] = {'differing_pixels': diff_images(labels['hex'], label)}
+        print('{:>22} {differing_pixels:>12} differing pixels'.format(name, **results[name]))
+        if results[name]['differing_pixels']:
+            raise RuntimeError('{} graphics differ from hex'.format(name))
+
+    # Printer side counting has to print the same labels as expanding every label on the host
+    for serial_options in [{'start': 1}, {'start': 95, 'width': 2}, {'start': 990, 'step': 7},
+                           {'start': 20, 'step': -1}, {'start': 7, 'minimum': 5, 'maximum': 12, 'prefix': 'SN'},
+                           {'start': 1, 'step': 150}]:
+        modes = {}
+        for printer_side in [True, False]:
+            serial = Serial(**serial_options)
+            ppla = PPLA()
+            ppla.serial_labels(lambda p: p.label_serial_text(10, 10, serial), 15, [serial], printer_side=printer_side)
+            emulator = PrinterEmulator()
+            emulator.send(ppla.get_bytes())
+            modes[printer_side] = emulator.labels
+        if len(modes[True]) != len(modes[False]) or any(diff_images(a, b) for a, b in zip(modes[True], modes[False])):
+            raise RuntimeError('Printer side serials differ from host side for {}'.format(serial_options))
+    print('{:>22} {:>12}'.format('serials', 'identical'))
+    return results
+
+
+def bench_graphics(repeat):
+    # Graphics cache against a fake printer that lists its graphics memory: bytes sent per job, checking that stored
+    # graphics are skipped, lost ones pruned and sent again, the least recently used evicted and that a printer
+    # without memory inquiry or a failed send do not leave graphics behind that were never stored
+    print('graphics cache')
+    print('{:>22} {:>12}'.format('job', 'bytes sent'))
+    images = [encode_image(random_image(200, 100, seed=seed)) for seed in range(3)]
+    size = len(images[0]) // 2
+    results = {}
+
+    def job(name, cache, printer, hexes):
+        ppla = PPLA()
+        names = cache.download_many(ppla, printer, hexes)
+        sent = printer._dev.bytes_received
+        cache.send(printer, ppla)
+        results[name] = {'bytes_sent': printer._dev.bytes_received - sent}
+        print('{:>22} {bytes_sent:>12}'.format(name, **results[name]))
+        return names
+
+    def check(condition, message):
+        if not condition:
+            raise RuntimeError('Graphics cache: ' + message)
+
+    printer = fake_printer(graphics_memory=64 * 1024)
+    cache = GraphicsCache()
+    names = job('first', cache, printer, images[:2])
+    check(set(printer._dev.stored_graphics) == set(names), 'graphics not stored')
+    job('unchanged', cache, printer, images[:2])
+    check(results['unchanged']['bytes_sent'] == 0, 'stored graphics sent again')
+    printer._dev.stored_graphics.clear()
+    job('after power cycle', cache, printer, images[:2])
+    check(set(printer._dev.stored_graphics) == set(names), 'lost graphics not sent again')
+
+    # Room for two images: downloading a third evicts the one used longest ago
+    printer = fake_printer(graphics_memory=2 * size + size // 2)
+    cache = GraphicsCache()
+    first, second = job('fill memory', cache, printer, images[:2])
+    job('use first', cache, printer, images[:1])
+    third, = job('evict', cache, printer, images[2:])
+    check(set(printer._dev.stored_graphics) == {first, third}, 'least recently used graphic not evicted')
+    # The first graphic is the least recently used, but the job uses it too, so the third one makes room
+    job('keep job graphics', cache, printer, [images[1], images[0]])
+    check(set(printer._dev.stored_graphics) == {first, second}, 'least recently used graphic not evicted')
+    check(results['keep job graphics']['bytes_sent'] < 4 * size, 'graphic of the same job evicted and sent again')
+
+    # No reply to the memory inquiry: graphics are downloaded once, nothing is evicted
+    printer = fake_printer()
+    cache = GraphicsCache()
+    job('no inquiry reply', cache, printer, images)
+    check(results['no inquiry reply']['bytes_sent'] > 3 * size, 'graphics not downloaded')
+    job('no reply, unchanged', cache, printer, images)
+    check(results['no reply, unchanged']['bytes_sent'] == 0, 'stored graphics sent again')
+
+    # A failed send rolls the downloads back, the next job sends them again
+    printer = fake_printer(graphics_memory=64 * 1024)
+    cache = GraphicsCache()
+    printer._dev.fail_after = printer._dev.bytes_received + size
+    try:
+        job('failed', cache, printer, images[:1])
+        check(False, 'send did not fail')
+    except TransferError:
+        pass
+    job('after failure', cache, printer, images[:1])
+    check(results['after failure']['bytes_sent'] > size, 'graphics of a failed send not sent again')
+    return results
+
+
+BENCHMARKS = {
+    'ppla_hex': bench_ppla_hex,
+    'compression': bench_compression,
+    'binary': bench_binary,
+    'template': bench_template,
+    'labels': bench_labels,
+    'fields': bench_fields,
+    'metrics': bench_metrics,
+    'transport': bench_transport,
+    'job': bench_job,
+    'emulator': bench_emulator,
+    'graphics': bench_graphics,
+}
+
+
+def compare(results, baseline):
+    print('change against baseline from {}'.format(baseline['timestamp']))
+    for benchmark, rows in results.items():
+        for row, metrics in rows.items():
+            for metric, value in metrics.items():
+                previous = baseline['results'].get(benchmark, {}).get(row, {}).get(metric)
+                if previous:
+                    print('{:>12} {:>20} {:>22} {:>+9.1f}%'.format(benchmark, row, metric, (value / previous - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PPLA benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run: {} (default: all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat', type=int, help='Number of timing repetitions', default=3)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results against a JSON file written by --output')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+        results[name] = BENCHMARKS[name](args.repeat)
+        print()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'timestamp': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
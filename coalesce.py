@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+from commands import parse_command
+from ppla import PPLA
+from stream import sink_writer
+
+
+def _commands(data):
+    offset = 0
+    while offset < len(data):
+        parsed = parse_command(data, offset)
+        if parsed is None:
+            yield None, None, data[offset:]
+            return
+        (prefix, payload), end = parsed
+        yield prefix, payload, data[offset:end]
+        offset = end
+
+
+def _chunks(data):
+    # Splits the data into printed label blocks, as (body, quantity, end) with the Q record taken out of the body,
+    # and everything else, as (raw bytes, None, end). end is the offset in data after the chunk.
+    block = None
+    offset = 0
+    for prefix, payload, raw in _commands(data):
+        offset += len(raw)
+        if block is None:
+            if prefix == 'STX' and payload == 'L':
+                block = {'body': [raw], 'raw': [raw], 'quantity': 1, 'increments': False}
+            else:
+                yield raw, None, offset
+            continue
+        block['raw'].append(raw)
+        if prefix == 'LINE' and payload[:1] == 'Q':
+            block['quantity'] = int(payload[1:])
+            continue
+        if prefix == 'LINE' and payload[:1] in ('+', '-'):
+            block['increments'] = True
+        if prefix == 'LINE' and payload in ('E', 'X'):
+            # Labels with incrementing fields differ from copy to copy, and X stores without printing
+            if payload == 'E' and not block['increments']:
+                yield b''.join(block['body']), block['quantity'], offset
+            else:
+                yield b''.join(block['raw']), None, offset
+            block = None
+            continue
+        block['body'].append(raw)
+    if block is not None:
+        yield b''.join(block['raw']), None, offset
+
+
+def coalesce_labels(data):
+    # Rewrites consecutive byte-identical label blocks into one block with the summed quantity
+    return coalesce_jobs([data])[0]
+
+
+def coalesce_jobs(jobs):
+    # coalesce_labels over the joined jobs, also returns for each job the offset in the result by which it is sent
+    # completely. A job whose last labels were merged with the next job's is complete once the merged block is.
+    data = b''.join(bytes(job) for job in jobs)
+    job_ends = []
+    for job in jobs:
+        job_ends.append((job_ends[-1] if job_ends else 0) + len(job))
+    result = bytearray()
+    ends = []
+    previous = None
+    quantity = 0
+    # Jobs that ended within the pending merged block
+    waiting = 0
+
+    def emit():
+        remaining = quantity
+        while remaining > 0:
+            ppla = PPLA()
+            count = min(remaining, PPLA._max_quantity)
+            if count > 1:
+                ppla.label_set_quantity(count)
+            result.extend(previous + ppla.label_end_job().get_bytes())
+            remaining -= count
+
+    for chunk, chunk_quantity, chunk_end in _chunks(data):
+        if chunk_quantity is not None and chunk == previous:
+            quantity += chunk_quantity
+        else:
+            if previous is not None:
+                emit()
+                previous = None
+                ends.extend([len(result)] * waiting)
+                waiting = 0
+            if chunk_quantity is None:
+                result += chunk
+            else:
+                previous, quantity = chunk, chunk_quantity
+        while len(ends) + waiting < len(job_ends) and job_ends[len(ends) + waiting] <= chunk_end:
+            if previous is None:
+                ends.append(len(result))
+            else:
+                waiting += 1
+    if previous is not None:
+        emit()
+    ends.extend([len(result)] * (len(job_ends) - len(ends)))
+    return bytes(result), ends
+
+
+class JobCoalescer:
+    # Sits between job submission and the printer. Jobs that arrive within latency seconds of the first one (up to
+    # max_bytes) are merged into one transfer, with identical consecutive labels turned into quantities.
+
+    def __init__(self, sink, latency=0.05, max_bytes=256 * 1024):
+        self._write = sink_writer(sink)
+        self._latency = latency
+        self._max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='ppla-coalescer', daemon=True)
+        self._thread.start()
+        self.jobs = 0
+        self.transfers = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            batch = [job]
+            size = len(job)
+            deadline = time.monotonic() + self._latency
+            while size < self._max_bytes:
+                try:
+                    job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+                size += len(job)
+            try:
+                if self._error is None:
+                    data = coalesce_labels(b''.join(batch))
+                    self._write(data)
+                    self.transfers += 1
+                    self.bytes_in += size
+                    self.bytes_out += len(data)
+            except Exception as e:
+                self._error = e
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Coalesced write failed: {}'.format(self._error)) from self._error
+
+    def send(self, data):
+        self._check_error()
+        self.jobs += 1
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
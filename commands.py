@@ -0,0 +1,77 @@
+# Splits PPLA data into commands. Kept apart from the emulator so tools that only parse do not need PIL.
+from ppla import PPLA
+
+SOH = PPLA.SOH[0]
+STX = PPLA.STX[0]
+CR = ord('\r')
+
+
+def _pcx_length(data, offset):
+    # PCX has no total length in its header, so run through the RLE data until all scan lines are complete
+    header = data[offset:offset + 128]
+    if len(header) < 128:
+        return None
+    planes = header[65]
+    bytes_per_line = int.from_bytes(header[66:68], 'little')
+    height = int.from_bytes(header[10:12], 'little') - int.from_bytes(header[6:8], 'little') + 1
+    remaining = planes * bytes_per_line * height
+    position = offset + 128
+    while remaining > 0:
+        if position >= len(data):
+            return None
+        if data[position] >= 0xC0:
+            remaining -= data[position] & 0x3F
+            position += 2
+        else:
+            remaining -= 1
+            position += 1
+    return position - offset if position <= len(data) else None
+
+
+def _bmp_length(data, offset):
+    if len(data) < offset + 6:
+        return None
+    return int.from_bytes(data[offset + 2:offset + 6], 'little')
+
+
+def parse_command(data, offset):
+    # Returns the next command as (prefix, payload) and the offset after it, or None if the command is incomplete.
+    # prefix is 'SOH', 'STX' or 'LINE' for everything else (label formatting records). Graphics downloads are
+    # returned as ('IMAGE', (memory, format, name, image_data)).
+    if offset >= len(data):
+        return None
+    if data[offset] == SOH:
+        if offset + 2 > len(data):
+            return None
+        end = offset + 2
+        if end < len(data) and data[end] == CR:
+            end += 1
+        return ('SOH', data[offset + 1:offset + 2].decode('ascii')), end
+    end = data.find(b'\r', offset)
+    if end < 0:
+        return None
+    if data[offset] != STX:
+        return ('LINE', data[offset:end].decode('ascii', errors='replace')), end + 1
+    if data[offset + 1:offset + 2] != b'I':
+        return ('STX', data[offset + 1:end].decode('ascii', errors='replace')), end + 1
+    memory = data[offset + 2:offset + 3].decode('ascii')
+    image_format = data[offset + 3:offset + 4].decode('ascii')
+    name = data[offset + 4:end].decode('ascii')
+    start = end + 1
+    if image_format == 'F':
+        terminator = data.find(b'FFFF', start)
+        if terminator < 0:
+            return None
+        length = terminator + 4 - start
+    elif image_format == 'B':
+        length = _bmp_length(data, start)
+    elif image_format == 'P':
+        length = _pcx_length(data, start)
+    else:
+        raise ValueError('Unsupported image format: ' + image_format)
+    if length is None or start + length > len(data):
+        return None
+    end = start + length
+    if image_format == 'F' and end < len(data) and data[end] == CR:
+        end += 1
+    return ('IMAGE', (memory, image_format, name, bytes(data[start:start + length]))), end
@@ -0,0 +1,269 @@
+import collections
+import functools
+import io
+import re
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from commands import parse_command
+from ppla import PPLA, decode_ppla_hex
+
+# Rotation of a field for each orientation character, counter-clockwise in degrees
+_ROTATIONS = {'1': 0, '4': 90, '3': 180, '2': 270}
+
+# Approximate character height in dots of the internal fonts, index is the font type character
+_FONT_HEIGHTS = {'0': 8, '1': 10, '2': 14, '3': 18, '4': 24, '5': 32, '6': 40, '7': 16, '8': 16, '9': 20, ':': 20}
+
+# Smooth font sizes selected by the font subtype of font type '9', in points
+_SMOOTH_FONT_POINTS = {'000': 4, '001': 6, '002': 8, '003': 10, '004': 12, '005': 14, '006': 16}
+
+# Field records are orientation, field type and size characters, y, x and then the data
+_FIELD_DATA_OFFSET = 15
+
+_SCALES = {value.decode('ascii'): key for key, value in PPLA._scales.items()}
+
+_INVERT = bytes(byte ^ 0xFF for byte in range(256))
+
+
+def decode_graphics(image_format, image_data):
+    if image_format == 'F':
+        rows = decode_ppla_hex(image_data)
+        row_bytes = len(rows[0]) if rows else 0
+        image = Image.frombytes('1', (row_bytes * 8, len(rows)), b''.join(rows).translate(_INVERT))
+        # ppla_hex sends the rows bottom up
+        return image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    return Image.open(io.BytesIO(image_data)).convert('1')
+
+
+@functools.lru_cache(maxsize=64)
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=4096)
+def _glyph(size, char):
+    # Text is put together from cached glyphs, rendering every string with FreeType would dominate the emulator
+    font = _font(size)
+    height = max(font.getbbox('Ag')[3], 1)
+    glyph = Image.new('1', (max(int(font.getlength(char)), 1), height), 1)
+    ImageDraw.Draw(glyph).text((0, 0), char, font=font, fill=0)
+    return glyph
+
+
+def _increment(data, amount):
+    # Counts the trailing digits of the data, keeping their width and wrapping around on overflow
+    match = re.search(r'\d+$', data)
+    if match is None:
+        return data
+    digits = match.group(0)
+    number = (int(digits) + amount) % 10 ** len(digits)
+    return data[:match.start()] + '{:0{}d}'.format(number, len(digits))
+
+
+def diff_images(a, b):
+    # Number of pixels that differ between two label images
+    if a.size != b.size:
+        raise ValueError('Images differ in size: {} and {}'.format(a.size, b.size))
+    return ImageChops.difference(a.convert('L'), b.convert('L')).point(lambda value: 255 if value else 0).histogram()[255]
+
+
+class PrinterEmulator:
+    # Takes the byte stream of PPLA.get_bytes() in place of a Printer and acts on it like a printer would: graphics
+    # and label formats are stored, and each printed label is rasterized to a PIL image at printer resolution.
+    # Coordinates are in 1/100 inch from the bottom left corner. Text uses PIL's default font and barcodes are drawn
+    # as a bar pattern derived from their data, so they are good for comparing outputs but not for scanning.
+    # Every label is kept in labels (about 86 KB each at 203 dpi), for long runs pass on_label to get each label image
+    # as it is printed and keep_labels to only keep the last that many (0 for none).
+
+    def __init__(self, dpi=203, width_inch=4.16, rasterize=True, on_label=None, keep_labels=None):
+        self.dpi = dpi
+        self.width_inch = width_inch
+        self.rasterize = rasterize
+        self.on_label = on_label
+        self.label_length_inch = 4.0
+        self.graphics = {}
+        self.formats = {}
+        self.labels = [] if keep_labels is None else collections.deque(maxlen=keep_labels)
+        self.label_count = 0
+        self.bytes_received = 0
+        self.commands = 0
+        self._buffer = bytearray()
+        self._offset = 0
+        self._label_mode = False
+        self._records = []
+        self._last_format = []
+        self._quantity = 1
+        # Rendered fields by record, labels of a batch mostly share most of their fields
+        self._field_cache = {}
+
+    def send(self, data):
+        self._buffer += data
+        self.bytes_received += len(data)
+        while True:
+            parsed = parse_command(self._buffer, self._offset)
+            if parsed is None:
+                break
+            command, self._offset = parsed
+            self.commands += 1
+            self._handle(*command)
+        del self._buffer[:self._offset]
+        self._offset = 0
+        return len(data)
+
+    write = send
+
+    def _handle(self, prefix, payload):
+        if prefix == 'IMAGE':
+            memory, image_format, name, image_data = payload
+            self.graphics[name.upper()] = decode_graphics(image_format, image_data) if self.rasterize else image_data
+            self._field_cache.clear()
+        elif prefix == 'STX':
+            self._handle_system(payload)
+        elif prefix == 'LINE' and self._label_mode:
+            self._handle_record(payload)
+
+    def _handle_system(self, payload):
+        code, argument = payload[:1], payload[1:]
+        if code == 'L':
+            self._label_mode = True
+            self._records = []
+            self._quantity = 1
+        elif code == 'c':
+            self.label_length_inch = int(argument) / 100
+        elif code == 'x' and argument[1:2] == 'G':
+            self.graphics.pop(argument[2:].upper(), None)
+            self._field_cache.clear()
+        elif code == 'U':
+            field = int(argument[:2])
+            fields = [index for index, record in enumerate(self._last_format) if record[:1] in _ROTATIONS]
+            if field <= len(fields):
+                record = self._last_format[fields[field - 1]]
+                self._last_format[fields[field - 1]] = record[:_FIELD_DATA_OFFSET] + argument[2:]
+        elif code == 'E':
+            self._quantity = int(argument)
+        elif code == 'G':
+            self._print(self._last_format, self._quantity)
+
+    def _handle_record(self, record):
+        code = record[:1]
+        if code in _ROTATIONS or code in ('+', '-'):
+            self._records.append(record)
+        elif code == 'Q':
+            self._quantity = int(record[1:])
+        elif code == 's':
+            self.formats[record[2:].upper()] = list(self._records)
+        elif code == 'r':
+            self._records = list(self.formats.get(record[1:].upper(), []))
+        elif code in ('E', 'X'):
+            self._label_mode = False
+            self._last_format = self._records
+            if code == 'E':
+                self._print(self._records, self._quantity)
+
+    def _print(self, records, quantity):
+        self.label_count += quantity
+        if not self.rasterize:
+            return
+        if not any(record[:1] in ('+', '-') for record in records):
+            image = self.render(records)
+            for _ in range(quantity):
+                self._output(image)
+            return
+        for copy in range(quantity):
+            self._output(self.render(self._incremented(records, copy)))
+
+    def _output(self, image):
+        self.labels.append(image)
+        if self.on_label is not None:
+            self.on_label(image)
+
+    def _incremented(self, records, copy):
+        # Applies the increment records to the field before them, as often as labels were printed before this copy
+        result = []
+        for record in records:
+            if record[:1] in ('+', '-') and result:
+                step = int(record[1:]) * (1 if record[0] == '+' else -1)
+                previous = result[-1]
+                result[-1] = previous[:_FIELD_DATA_OFFSET] + _increment(previous[_FIELD_DATA_OFFSET:], step * copy)
+            elif record[:1] in _ROTATIONS:
+                result.append(record)
+        return result
+
+    def _dots(self, hundredths):
+        return hundredths * self.dpi // 100
+
+    def render(self, records):
+        width = round(self.width_inch * self.dpi)
+        height = round(self.label_length_inch * self.dpi)
+        label = Image.new('1', (width, height), 1)
+        for record in records:
+            mask = self._field_cache.get(record)
+            if mask is None:
+                if len(self._field_cache) > 1024:
+                    self._field_cache.clear()
+                mask = self._field_cache[record] = self._field_mask(record)
+            if mask is None:
+                continue
+            x = self._dots(int(record[11:15]))
+            y = self._dots(int(record[7:11]))
+            # Paste the black pixels only, so overlapping fields are or-ed like on the printer
+            label.paste(0, (x, height - y - mask.size[1]), mask)
+        return label
+
+    def _field_mask(self, record):
+        field = self._render_field(record)
+        if field is None:
+            return None
+        rotation = _ROTATIONS[record[0]]
+        if rotation:
+            field = field.rotate(rotation, expand=True, fillcolor=1)
+        return ImageChops.invert(field.convert('L'))
+
+    def _render_field(self, record):
+        kind = record[1]
+        data = record[_FIELD_DATA_OFFSET:]
+        if kind == 'Y':
+            return self.graphics.get(data.upper())
+        if kind == 'X':
+            shape = data[:1]
+            width = self._dots(int(data[1:4]))
+            height = self._dots(int(data[4:7]))
+            field = Image.new('1', (max(width, 1), max(height, 1)), 0)
+            if shape == 'B':
+                top_bottom = max(self._dots(int(data[7:10])), 1)
+                left_right = max(self._dots(int(data[10:13])), 1)
+                ImageDraw.Draw(field).rectangle((left_right, top_bottom, width - 1 - left_right, height - 1 - top_bottom), fill=1)
+            return field
+        if kind.isdigit() or kind == ':':
+            return self._render_text(kind, record[2:3], record[3:4], record[4:7], data)
+        return self._render_barcode(record[2:3], record[3:4], record[4:7], data)
+
+    def _render_text(self, font_type, h_scale, v_scale, subtype, data):
+        if font_type == '9':
+            size = _SMOOTH_FONT_POINTS.get(subtype, 10) * self.dpi // 72
+        else:
+            size = _FONT_HEIGHTS.get(font_type, 16)
+        glyphs = [_glyph(size, char) for char in data or ' ']
+        field = Image.new('1', (sum(glyph.size[0] for glyph in glyphs), glyphs[0].size[1]), 1)
+        x = 0
+        for glyph in glyphs:
+            field.paste(glyph, (x, 0))
+            x += glyph.size[0]
+        h_scale = max(_SCALES.get(h_scale, 1), 1)
+        v_scale = max(_SCALES.get(v_scale, 1), 1)
+        if h_scale > 1 or v_scale > 1:
+            field = field.resize((field.size[0] * h_scale, field.size[1] * v_scale))
+        return field
+
+    def _render_barcode(self, wide, narrow, height, data):
+        wide = max(int(wide), 1)
+        narrow = max(int(narrow), 1)
+        height = max(self._dots(int(height)), self.dpi // 4)
+        row = bytearray()
+        for byte in data.encode('ascii', errors='replace') or b' ':
+            for bit in range(8):
+                # Alternate black and white bars, a set bit makes the bar wide
+                row += (b'\x00' if bit % 2 == 0 else b'\xff') * (wide if byte & (0x80 >> bit) else narrow)
+        field = Image.frombytes('L', (len(row), 1), bytes(row)).resize((len(row), height)).convert('1')
+        return field
@@ -0,0 +1,151 @@
+import json
+import os
+from commands import parse_command
+from ppla import PPLA
+
+# Inches per second by speed letter, as used by label_set_print_speed (P) and set_label_feed_rate (STX S)
+_SPEEDS = {code.decode('ascii'): float(rate) for rate, code in PPLA._label_feed_rates.items()}
+
+
+def _fit(samples):
+    # Least squares fit of y = a * x1 + b * x2 over (x1, x2, y) samples, returns (a, b) or None if underdetermined
+    s11 = sum(x1 * x1 for x1, _, _ in samples)
+    s12 = sum(x1 * x2 for x1, x2, _ in samples)
+    s22 = sum(x2 * x2 for _, x2, _ in samples)
+    s1y = sum(x1 * y for x1, _, y in samples)
+    s2y = sum(x2 * y for _, x2, y in samples)
+    determinant = s11 * s22 - s12 * s12
+    if abs(determinant) <= 1e-12 * max(s11 * s22, 1e-300):
+        return None
+    return (s1y * s22 - s2y * s12) / determinant, (s2y * s11 - s1y * s12) / determinant
+
+
+class JobEstimator:
+    # Predicts how long a job takes: the transfer time from its size (link_rate bytes per second plus
+    # transfer_overhead seconds per transfer) and the print time from the labels it prints, each label moving
+    # label_length_inch at its print speed and gap_inch at the feed rate plus label_overhead seconds. Printing starts
+    # as soon as the first label has arrived and overlaps with the rest of the transfer. The defaults are rough, use
+    # calibrate_transfer and calibrate_print with measured runs to match a real printer.
+
+    def __init__(self, link_rate=1000000.0, transfer_overhead=0.001, print_speed='2.0', feed_rate='2.0',
+                 label_length_inch=4.0, gap_inch=0.12, label_overhead=0.1, speed_factor=1.0):
+        self.link_rate = link_rate
+        self.transfer_overhead = transfer_overhead
+        # Speeds the printer uses when the job does not set them
+        self.print_speed = float(print_speed)
+        self.feed_rate = float(feed_rate)
+        self.label_length_inch = label_length_inch
+        self.gap_inch = gap_inch
+        self.label_overhead = label_overhead
+        # Ratio of the real to the nominal motion time
+        self.speed_factor = speed_factor
+
+    _parameters = ['link_rate', 'transfer_overhead', 'print_speed', 'feed_rate', 'label_length_inch', 'gap_inch',
+                   'label_overhead', 'speed_factor']
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({name: getattr(self, name) for name in self._parameters}, f, indent=2)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        if os.path.exists(path):
+            with open(path) as f:
+                kwargs = dict(json.load(f), **kwargs)
+        return cls(**kwargs)
+
+    def analyze(self, job):
+        # Walks the commands of a job (a PPLA or its bytes) and sums up what is printed
+        data = bytes(job.get_bytes() if isinstance(job, PPLA) else job)
+        label_length = self.label_length_inch
+        feed_rate = self.feed_rate
+        speed = self.print_speed
+        quantity = 1
+        stored_quantity = 1
+        labels = 0
+        motion_seconds = 0.0
+        first_label_bytes = None
+        offset = 0
+        while offset < len(data):
+            parsed = parse_command(data, offset)
+            if parsed is None:
+                break
+            (prefix, payload), offset = parsed
+            printed = 0
+            if prefix == 'STX':
+                code, argument = payload[:1], payload[1:]
+                if code == 'L':
+                    speed = self.print_speed
+                    quantity = 1
+                elif code == 'c':
+                    label_length = int(argument) / 100
+                elif code == 'S':
+                    feed_rate = _SPEEDS.get(argument, feed_rate)
+                elif code == 'E':
+                    stored_quantity = int(argument)
+                elif code == 'G':
+                    # Prints the last format again, at its speed
+                    printed = stored_quantity
+            elif prefix == 'LINE':
+                code = payload[:1]
+                if code == 'P':
+                    speed = _SPEEDS.get(payload[1:], speed)
+                elif code == 'Q':
+                    quantity = int(payload[1:])
+                elif payload == 'E':
+                    printed = quantity
+            if printed:
+                labels += printed
+                motion_seconds += printed * (label_length / speed + self.gap_inch / feed_rate)
+                if first_label_bytes is None:
+                    first_label_bytes = offset
+        return {
+            'bytes': len(data),
+            'labels': labels,
+            'motion_seconds': motion_seconds,
+            'first_label_bytes': first_label_bytes or 0,
+        }
+
+    def _transfer_seconds(self, size, transfers=1):
+        return size / self.link_rate + transfers * self.transfer_overhead if size else 0.0
+
+    def estimate(self, job, transfers=1):
+        analysis = self.analyze(job)
+        transfer_seconds = self._transfer_seconds(analysis['bytes'], transfers)
+        print_seconds = analysis['motion_seconds'] * self.speed_factor + analysis['labels'] * self.label_overhead
+        startup_seconds = self._transfer_seconds(analysis['first_label_bytes']) if analysis['labels'] else 0.0
+        return dict(analysis,
+                    transfer_seconds=transfer_seconds,
+                    print_seconds=print_seconds,
+                    seconds=max(transfer_seconds, startup_seconds + print_seconds))
+
+    def cost(self, job):
+        # Predicted seconds, e.g. to order a queue shortest job first or to balance work between printers
+        return self.estimate(job)['seconds']
+
+    def calibrate_transfer(self, runs):
+        # runs are (bytes, seconds, transfers) of measured transfers, e.g. from Printer.get_transfer_stats
+        fit = _fit([(size, transfers, seconds) for size, seconds, transfers in runs])
+        if fit is None or fit[0] <= 0:
+            raise ValueError('Need transfers of at least two different sizes to calibrate')
+        self.link_rate = 1 / fit[0]
+        self.transfer_overhead = max(fit[1], 0.0)
+        return self
+
+    def calibrate_print(self, runs):
+        # runs are (job, seconds) with the measured time of the whole job, from the start of the transfer to the last
+        # label printed, for jobs that print slower than they transfer. As in estimate, printing starts once the first
+        # label has arrived, so that modelled startup is taken off (calibrate_transfer first).
+        samples = []
+        for job, seconds in runs:
+            analysis = self.analyze(job)
+            if not analysis['labels']:
+                continue
+            startup_seconds = self._transfer_seconds(analysis['first_label_bytes'])
+            samples.append((analysis['motion_seconds'], analysis['labels'], seconds - startup_seconds))
+        fit = _fit(samples)
+        if fit is None or fit[0] <= 0:
+            raise ValueError('Need jobs with different label lengths or speeds to calibrate')
+        self.speed_factor = fit[0]
+        self.label_overhead = max(fit[1], 0.0)
+        return self
@@ -0,0 +1,118 @@
+import time
+import usb.core
+from commands import parse_command
+from printer import Printer
+
+
+class FakeEndpoint:
+    def __init__(self, address, max_packet_size, device=None):
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = max_packet_size
+        self._device = device
+
+    def read(self, length, timeout=None):
+        return self._device.read(length, timeout)
+
+
+class FakeDevice:
+    # Stands in for a pyusb device. Bulk writes are split into wMaxPacketSize packets and take the time the link
+    # needs for them: a fixed overhead per write call plus the packet bytes at the given bandwidth. With realtime the
+    # time is slept, otherwise it is only added up in link_seconds so benchmarks are reproducible.
+    # Setting fail_after makes the write that would go past that many received bytes time out once. A soft reset
+    # drops a label the printer has only partly received, and status requests (SOH A) are answered with reply_status.
+    # With graphics_memory (in bytes) the device keeps track of the graphics downloaded and deleted in
+    # stored_graphics (name to size) and answers the graphics memory inquiry (STX WG) with them and the free memory.
+    # Without it the inquiry is not answered, like on printers that do not support it.
+
+    def __init__(self, max_packet_size=64, bandwidth=1000000, call_overhead=0.001, realtime=False, status=0x18, device_id='MFG:Argox;MDL:R-400;',
+                 graphics_memory=None):
+        self.max_packet_size = max_packet_size
+        self.bandwidth = bandwidth
+        self.call_overhead = call_overhead
+        self.realtime = realtime
+        self.status = status
+        self.device_id = device_id
+        self.bus = 1
+        self.address = 1
+        self.received = bytearray()
+        self.bytes_received = 0
+        self.keep_data = True
+        self.write_calls = 0
+        self.packets = 0
+        self.link_seconds = 0.0
+        self.fail_after = None
+        self.soft_resets = 0
+        self.reply_status = 'NNNNNNNN'
+        self._replies = []
+        self.graphics_memory = graphics_memory
+        self.stored_graphics = {}
+        self._commands = bytearray()
+
+    def write(self, endpoint, data, timeout=None):
+        length = len(data)
+        if self.fail_after is not None and self.bytes_received + length > self.fail_after:
+            self.fail_after = None
+            raise usb.core.USBTimeoutError('Operation timed out')
+        if bytes(data[:2]) == b'\x01A':
+            self._replies.append(self.reply_status.encode('ascii') + b'\r')
+        packets = max(1, -(-length // self.max_packet_size))
+        seconds = self.call_overhead + packets * self.max_packet_size / self.bandwidth
+        self.write_calls += 1
+        self.bytes_received += length
+        self.packets += packets
+        self.link_seconds += seconds
+        if self.realtime:
+            time.sleep(seconds)
+        if self.keep_data:
+            self.received += data
+        if self.graphics_memory is not None:
+            self._track_graphics(data)
+        return length
+
+    def _track_graphics(self, data):
+        self._commands += data
+        offset = 0
+        while True:
+            parsed = parse_command(self._commands, offset)
+            if parsed is None:
+                break
+            (prefix, payload), offset = parsed
+            if prefix == 'IMAGE':
+                _, image_format, name, image_data = payload
+                self.stored_graphics[name.upper()] = len(image_data) // 2 if image_format == 'F' else len(image_data)
+            elif prefix == 'STX' and payload[:1] == 'x' and payload[2:3] == 'G':
+                self.stored_graphics.pop(payload[3:].upper(), None)
+            elif prefix == 'STX' and payload == 'WG':
+                lines = ['{} {}'.format(name, size) for name, size in self.stored_graphics.items()]
+                lines.append('AVAIL {}'.format(self.graphics_memory - sum(self.stored_graphics.values())))
+                self._replies.append('\r'.join(lines).encode('ascii') + b'\r')
+        del self._commands[:offset]
+
+    def ctrl_transfer(self, request_type, request, value, index, length):
+        if request == Printer.CLASS_REQUEST_GET_DEVICE_ID:
+            data = len(self.device_id).to_bytes(2, 'big') + self.device_id.encode('ascii')
+            return data[:length]
+        if request == Printer.CLASS_REQUEST_GET_PORT_STATUS:
+            return bytes([self.status])
+        if request == Printer.CLASS_REQUEST_SOFT_RESET:
+            self.soft_resets += 1
+            label_start = self.received.rfind(b'\x02L\r')
+            if label_start >= 0 and self.received.find(b'E\r', label_start) < 0:
+                del self.received[label_start:]
+        return b''
+
+    def read(self, length, timeout=None):
+        if not self._replies:
+            raise usb.core.USBTimeoutError('Operation timed out')
+        return self._replies.pop(0)[:length]
+
+
+def fake_printer(**kwargs):
+    # A Printer that is already "open" on a FakeDevice
+    printer = Printer(0, 0)
+    printer._dev = FakeDevice(**kwargs)
+    printer._bus = printer._dev.bus
+    printer._address = printer._dev.address
+    printer._ep_out = FakeEndpoint(0x01, printer._dev.max_packet_size)
+    printer._ep_in = FakeEndpoint(0x81, printer._dev.max_packet_size, printer._dev)
+    return printer
@@ -0,0 +1,164 @@
+import copy
+import hashlib
+import json
+import os
+import time
+from PIL import Image
+from ppla import PPLA, encode_image
+from status import parse_memory_status
+
+
+def graphics_name(ppla_hex):
+    # Graphics names are limited to 16 characters, so use a truncated content hash
+    return 'G' + hashlib.sha1(bytes(ppla_hex)).hexdigest()[:15].upper()
+
+
+def split_tiles(image, x, y, tile_size=50, dpi=203, units_per_inch=100):
+    # Cuts an image that is placed at x, y (its lower left corner, in coordinate units) into tiles of tile_size units
+    # and returns them as a list of (x, y, tile image). Tile edges are put where the printer converts the tile
+    # coordinates to dots, so the tiles line up without gaps. Tiles are padded with white to a multiple of 8 dots
+    # wide, which does not cover the neighbours as fields are or-ed. All white tiles are left out.
+    image = image.convert('1')
+    width, height = image.size
+
+    def edges(origin, size):
+        start = origin * dpi // units_per_inch
+        result = [0]
+        while result[-1] < size:
+            units = origin + len(result) * tile_size
+            result.append(min(units * dpi // units_per_inch - start, size))
+        return result
+
+    columns = edges(x, width)
+    rows = edges(y, height)
+    tiles = []
+    for row, (bottom, top) in enumerate(zip(rows, rows[1:])):
+        for column, (left, right) in enumerate(zip(columns, columns[1:])):
+            tile = image.crop((left, height - top, right, height - bottom))
+            if tile.getextrema()[0] == 255:
+                continue
+            if tile.size[0] % 8:
+                padded = Image.new('1', (tile.size[0] + 8 - tile.size[0] % 8, tile.size[1]), 1)
+                padded.paste(tile, (0, 0))
+                tile = padded
+            tiles.append((x + column * tile_size, y + row * tile_size, tile))
+    return tiles
+
+
+class GraphicsCache:
+    # Entries are kept per printer, keyed by Printer.location (bus:address) or an explicit printer_id, e.g. a serial
+    # number that stays the same when the printer is plugged in elsewhere. The IEEE 1284 device ID is no key, as
+    # identical printers report the same one.
+    # Downloads only count once their data reached the printer: send the job with send(), or call commit() after
+    # sending it yourself and rollback() if that failed, so graphics that were never stored are downloaded again.
+
+    def __init__(self, path=None):
+        self._path = path
+        self._printers = {}
+        # The entries as of the last commit, while there are downloads that are not sent yet
+        self._committed = None
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._printers = json.load(f)
+
+    def _save(self):
+        if self._path is not None:
+            with open(self._path, 'w') as f:
+                json.dump(self._printers if self._committed is None else self._committed, f, indent=2)
+
+    def _entries(self, printer_id, memory):
+        return self._printers.setdefault(printer_id, {}).setdefault(memory, {})
+
+    @staticmethod
+    def _printer_id(printer, printer_id):
+        return printer_id if printer_id is not None else printer.location
+
+    def _query_memory_status(self, printer):
+        printer.send(PPLA().inquire_graphics_memory_status().get_bytes())
+        try:
+            reply = printer.recv(1024)
+        except OSError:
+            # Printers that do not answer the inquiry (a USB timeout is an OSError) leave the memory status unknown
+            reply = b''
+        return parse_memory_status(reply)
+
+    def _sync(self, printer, entries):
+        # Returns the free graphics memory, None if unknown. Then nothing is pruned or evicted, only downloaded.
+        status = self._query_memory_status(printer)
+        if status['names'] or status['free_bytes'] is not None:
+            # Anything the printer no longer lists was lost, e.g. by a reset or power cycle
+            for name in [name for name in entries if name not in status['names']]:
+                del entries[name]
+        return status['free_bytes']
+
+    def _make_room(self, ppla, entries, memory, free_bytes, size, keep=()):
+        for name in sorted(entries, key=lambda name: entries[name]['last_used']):
+            if free_bytes >= size:
+                break
+            if name in keep:
+                continue
+            ppla.delete_graphics(name, memory=memory)
+            free_bytes += entries.pop(name)['size']
+        return free_bytes
+
+    def download(self, ppla, printer, ppla_hex, memory='ram', printer_id=None):
+        return self.download_many(ppla, printer, [ppla_hex], memory=memory, printer_id=printer_id)[0]
+
+    def download_many(self, ppla, printer, ppla_hexes, memory='ram', printer_id=None):
+        # Same as download for several graphics, with a single memory inquiry
+        if self._committed is None:
+            self._committed = copy.deepcopy(self._printers)
+        entries = self._entries(self._printer_id(printer, printer_id), memory)
+        free_bytes = self._sync(printer, entries)
+        now = time.time()
+        names = [graphics_name(ppla_hex) for ppla_hex in ppla_hexes]
+        # None of the graphics of this job may be evicted to make room for another one of them
+        keep = set(names)
+        for name, ppla_hex in zip(names, ppla_hexes):
+            if name not in entries:
+                size = len(ppla_hex) // 2
+                if free_bytes is not None:
+                    free_bytes = self._make_room(ppla, entries, memory, free_bytes, size, keep=keep) - size
+                ppla.download_graphics(name, ppla_hex, memory=memory)
+                entries[name] = {'size': size}
+            entries[name]['last_used'] = now
+        return names
+
+    def commit(self):
+        # The downloads since the last commit or rollback were sent to the printer
+        self._committed = None
+        self._save()
+
+    def rollback(self):
+        # Sending the downloads failed, forget them so they are downloaded again
+        if self._committed is not None:
+            self._printers = self._committed
+            self._committed = None
+
+    def send(self, printer, ppla):
+        # Sends a job holding downloads of this cache and commits them, or rolls them back if the send fails
+        try:
+            printer.send(ppla.get_bytes())
+        except Exception:
+            self.rollback()
+            raise
+        self.commit()
+
+    def download_tiled(self, ppla, printer, image, x, y, tile_size=50, memory='ram', compress=False, dpi=203,
+                       printer_id=None):
+        # Downloads a large image as tiles (see split_tiles). Tiles are named by their content, so when the image
+        # changes in a small area only the tiles covering it are sent again. Returns the graphic fields placing the
+        # tiles, for PPLA.add_fields in label mode.
+        tiles = split_tiles(image, x, y, tile_size=tile_size, dpi=dpi)
+        names = self.download_many(ppla, printer, [encode_image(tile, compress=compress) for _, _, tile in tiles],
+                                   memory=memory, printer_id=printer_id)
+        return [{'type': 'graphic', 'x': tile_x, 'y': tile_y, 'name': name}
+                for (tile_x, tile_y, _), name in zip(tiles, names)]
+
+    def forget(self, printer, memory=None, printer_id=None):
+        printer_id = self._printer_id(printer, printer_id)
+        for printers in [self._printers, self._committed or {}]:
+            stored = printers.get(printer_id, {})
+            for memory_type in [memory] if memory is not None else list(stored):
+                stored.pop(memory_type, None)
+        self._save()
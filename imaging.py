@@ -0,0 +1,114 @@
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+from PIL import Image
+from ppla import ppla_hex, ppla_hex_compressed, ppla_binary
+
+_ENCODERS = {
+    'hex': ppla_hex,
+    'hex-compressed': ppla_hex_compressed,
+    'bmp': lambda image: ppla_binary(image, 'bmp'),
+    'pcx': lambda image: ppla_binary(image, 'pcx'),
+}
+
+
+def prepare_image(image, width=None, height=None, dither=True, threshold=128):
+    # Scales the image to the given size in printer dots (keeping the aspect ratio if only one is given) and
+    # converts it to black and white, either Floyd-Steinberg dithered or with a fixed threshold
+    image = image.convert('L')
+    if width is not None or height is not None:
+        if width is None:
+            width = max(round(image.size[0] * height / image.size[1]), 1)
+        if height is None:
+            height = max(round(image.size[1] * width / image.size[0]), 1)
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    if dither:
+        return image.convert('1')
+    return image.point(lambda value: 255 if value >= threshold else 0).convert('1', dither=Image.Dither.NONE)
+
+
+def encode_image_data(data, encoding='hex', **options):
+    if encoding not in _ENCODERS:
+        raise ValueError('Invalid encoding: {}, valid encodings are: {}'.format(encoding, ', '.join(_ENCODERS)))
+    return bytes(_ENCODERS[encoding](prepare_image(Image.open(io.BytesIO(data)), **options)))
+
+
+class ImageCache:
+    # Encoded images on disk, keyed by image content and encoding options. Once the files take up more than
+    # max_bytes, the least recently used ones are removed.
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(data, options):
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(options, sort_keys=True).encode('ascii'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.ppla')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.ppla'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def encode_images(paths, cache=None, processes=None, encoding='hex', **options):
+    # Encodes a batch of image files on a process pool and returns the results in the order of paths.
+    # Images that are in the cache, or appear more than once in the batch, are only converted once.
+    options = dict(options, encoding=encoding)
+    keys = []
+    contents = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = ImageCache.key(data, options)
+        keys.append(key)
+        contents[key] = data
+
+    results = {}
+    if cache is not None:
+        for key in contents:
+            cached = cache.get(key)
+            if cached is not None:
+                results[key] = cached
+    missing = [key for key in contents if key not in results]
+    if missing:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {key: executor.submit(encode_image_data, contents[key], **options) for key in missing}
+            for key, future in futures.items():
+                results[key] = future.result()
+                if cache is not None:
+                    cache.put(key, results[key])
+    return [results[key] for key in keys]
@@ -0,0 +1,174 @@
+import csv
+import io
+import json
+import queue
+import re
+import sys
+import threading
+from ppla import PPLA
+from template import LabelTemplate
+
+# {column} in a field's data is replaced by the value of that column of each record
+_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+_INPUT_FORMATS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+}
+
+
+def input_format(path, default='csv'):
+    for extension, name in _INPUT_FORMATS.items():
+        if path.lower().endswith(extension):
+            return name
+    return default
+
+
+def read_records(stream, format='csv'):
+    # Yields the records of a text stream one by one, as dicts of column values
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    elif format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('Unknown input format: {}'.format(format))
+
+
+def open_records(path, format=None):
+    # Reads records from a file, or from stdin if path is '-'
+    format = format or input_format(path)
+    if path == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        yield from read_records(stream, format)
+        return
+    with open(path, encoding='utf-8', newline='') as stream:
+        yield from read_records(stream, format)
+
+
+class Layout:
+    # A label layout as described in a JSON file, e.g.
+    #   {"label_length_inch": 2.65, "transfer_type": "direct-thermal", "print_speed": "3.0", "quantity": "{copies}",
+    #    "fields": [{"type": "text", "x": 100, "y": 2, "data": "Hello {name}", "font": "asd-12"}]}
+    # fields are as taken by PPLA.add_fields. The layout is compiled to a template once, so each record is rendered by
+    # joining precompiled bytes with its values.
+
+    def __init__(self, fields, label_length_inch=None, transfer_type=None, print_speed=None, quantity=1):
+        setup = PPLA()
+        if transfer_type is not None:
+            setup.set_transfer_type(transfer_type)
+        if label_length_inch is not None:
+            setup.set_label_length_inch(label_length_inch)
+        self.setup = bytes(setup.get_bytes())
+
+        template = LabelTemplate()
+        template.enter_label_mode()
+        if print_speed is not None:
+            template.label_set_print_speed(print_speed)
+        template.add_fields([self._with_slots(template, field) for field in fields])
+        self._template = template.compile()
+        self._quantity = quantity
+        # Quantity and end of label records by quantity
+        self._endings = {}
+
+    @staticmethod
+    def _with_slots(template, field):
+        field = dict(field)
+        if isinstance(field.get('data'), str):
+            field['data'] = _PLACEHOLDER.sub(lambda match: template.slot(match.group(1)), field['data'])
+        return field
+
+    _keys = {'fields', 'label_length_inch', 'transfer_type', 'print_speed', 'quantity'}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            description = json.load(f)
+        if not isinstance(description, dict) or 'fields' not in description:
+            raise ValueError('Layout {} needs an object with fields'.format(path))
+        unknown = set(description) - cls._keys
+        if unknown:
+            raise ValueError('Unknown layout keys in {}: {}'.format(path, ', '.join(sorted(unknown))))
+        try:
+            return cls(**description)
+        except TypeError as e:
+            # e.g. a field with an argument its label_* method does not take
+            raise ValueError('Invalid layout {}: {}'.format(path, e)) from e
+
+    def quantity(self, record):
+        if isinstance(self._quantity, str):
+            return int(_PLACEHOLDER.sub(lambda match: str(record[match.group(1)]), self._quantity))
+        return self._quantity
+
+    def _ending(self, quantity):
+        ending = self._endings.get(quantity)
+        if ending is None:
+            ppla = PPLA()
+            if quantity != 1:
+                ppla.label_set_quantity(quantity)
+            ending = self._endings[quantity] = bytes(ppla.label_end_job().get_bytes())
+        return ending
+
+    def render(self, record):
+        return self._template.render(record) + self._ending(self.quantity(record))
+
+
+def _with_timeouts(records, timeout):
+    # Yields the records as a reader thread gets them, and None whenever timeout seconds pass without a record
+    items = queue.Queue(maxsize=1024)
+
+    def read():
+        try:
+            for record in records:
+                items.put(('record', record))
+            items.put(('end', None))
+        except Exception as e:
+            items.put(('error', e))
+
+    threading.Thread(target=read, name='ppla-records', daemon=True).start()
+    while True:
+        try:
+            kind, value = items.get(timeout=timeout)
+        except queue.Empty:
+            yield None
+            continue
+        if kind == 'end':
+            return
+        if kind == 'error':
+            raise value
+        yield value
+
+
+def stream_labels(layout, records, write, buffer_size=64 * 1024, max_latency=None):
+    # Renders the records as they are read and writes the data in pieces of about buffer_size bytes. With
+    # max_latency, e.g. for a live feed on stdin, the data is also written when no record came for that many seconds.
+    # Returns the number of records and bytes written.
+    buffer = bytearray(layout.setup)
+    count = 0
+    size = 0
+    if max_latency is not None:
+        records = _with_timeouts(records, max_latency)
+    for record in records:
+        if record is None:
+            if buffer:
+                write(bytes(buffer))
+                size += len(buffer)
+                buffer.clear()
+            continue
+        count += 1
+        try:
+            buffer += layout.render(record)
+        except KeyError as e:
+            raise ValueError('Record {}: missing column {}'.format(count, e)) from e
+        except ValueError as e:
+            raise ValueError('Record {}: {}'.format(count, e)) from e
+        if len(buffer) >= buffer_size:
+            write(bytes(buffer))
+            size += len(buffer)
+            buffer.clear()
+    if buffer:
+        write(bytes(buffer))
+        size += len(buffer)
+    return count, size
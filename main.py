@@ -1,8 +1,7 @@
 import argparse
-import usb.core
+import itertools
 import sys
-from ppla import PPLA, ppla_hex
-from PIL import Image
+import time
 
 
 def error(msg):
@@ -10,145 +9,94 @@ def error(msg):
     exit(1)
 
 
-class Printer:
-    CLASS_REQUEST_GET_DEVICE_ID = 0x00
-    CLASS_REQUEST_GET_PORT_STATUS = 0x01
-    CLASS_REQUEST_SOFT_RESET = 0x02
-
-    def __init__(self, vendor_id, product_id):
-        self._dev = None
-        self._vendor_id = vendor_id
-        self._product_id = product_id
-        self._ep_in = None
-        self._ep_out = None
-
-    def __enter__(self):
-        self.open()
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
-
-    def open(self):
-        self._dev = usb.core.find(idVendor=self._vendor_id, idProduct=self._product_id)
-        if self._dev is None:
-            error('Device not found')
-        self._dev.set_configuration()
-
-        # find endpoints
-        cfg = self._dev.get_active_configuration()
-        intf = cfg[(0, 0)]
-        self._ep_out = usb.util.find_descriptor(
-            intf,
-            # match the first OUT endpoint
-            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT
-        )
-        if self._ep_out is None:
-            error('Endpoint OUT not found')
-        self._ep_in = usb.util.find_descriptor(
-            intf,
-            # match the first IN endpoint
-            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN
-        )
-        if self._ep_in is None:
-            error('Endpoint IN not found')
-
-    def close(self):
-        if self._dev is not None:
-            usb.util.dispose_resources(self._dev)
-            self._dev = None
-            self._ep_in = None
-            self._ep_out = None
-
-    def _perform_class_request(self, request, value, index, length):
-        request_type = usb.util.build_request_type(
-            direction=usb.util.CTRL_IN,
-            type=usb.util.CTRL_TYPE_CLASS,
-            recipient=usb.util.CTRL_RECIPIENT_INTERFACE
-        )
-        return self._dev.ctrl_transfer(request_type, request, value, index, length)
-
-    def get_device_id(self):
-        data = self._perform_class_request(
-            self.CLASS_REQUEST_GET_DEVICE_ID,
-            value=0,
-            index=0,
-            length=64
-        )
-        return ''.join([chr(c) for c in data])
-
-    def get_port_status(self):
-        data = self._perform_class_request(
-            self.CLASS_REQUEST_GET_PORT_STATUS,
-            value=0,
-            index=0,
-            length=1
-        )
-        result = {
-            'paper_empty': bool(data[0] & (1 << 5)),
-            'select': bool(data[0] & (1 << 4)),
-            'error': not bool(data[0] & (1 << 3)),
-        }
-        return result
-
-    def soft_reset(self):
-        data = self._perform_class_request(
-            self.CLASS_REQUEST_SOFT_RESET,
-            value=0,
-            index=0,
-            length=0
-        )
-        return data
-
-    def send(self, data):
-        offset = 0
-        size = len(data)
-        while offset < size:
-            write_size = self._ep_out.wMaxPacketSize
-            if offset + write_size > size:
-                write_size = size - offset
-            length = self._dev.write(self._ep_out.bEndpointAddress, data[offset:offset + write_size])
-            if length <= 0:
-                raise RuntimeError("USB bulk write error")
-            offset += length
-        return offset
-
-    def recv(self, length):
-        return self._ep_in.read(length)
+def print_demo_label(p, args):
+    # Only the demo needs PIL, so it is imported here to keep the other commands starting fast
+    from PIL import Image
+    from ppla import PPLA, ppla_hex
+    from graphics import GraphicsCache
+
+    print(p.get_device_id())
+    print(p.get_port_status())
+    print(p.soft_reset())
+
+    tux_hex = ppla_hex(Image.open('tux.jpg'))
+
+    ppla = PPLA()
+    ppla.set_transfer_type('direct-thermal')
+    ppla.set_label_length_inch(2.65)
+    cache = GraphicsCache(args.graphics_cache)
+    tux = cache.download(ppla, p, tux_hex, memory='ram')
+    ppla.enter_label_mode()
+    ppla.label_set_pixel_size()
+    ppla.label_graphic(100, 16, tux)
+    ppla.label_text(100, 2, 'Hello World!', font='asd-12')
+    ppla.label_barcode(260, 40, 'A' + 'TUX', barcode_type='code-128', orientation='landscape')
+    ppla.label_end_job()
+
+    # perform print, the cache only remembers tux once it was sent
+    cache.send(p, ppla)
+    print(p.get_transfer_stats())
+
+
+def print_records(args):
+    from layout import Layout, open_records, stream_labels
+
+    layout = Layout.load(args.layout)
+    inputs = args.input or ['-']
+    records = itertools.chain.from_iterable(open_records(path, args.format) for path in inputs)
+    # stdin may be a live feed, so labels must not wait in the buffer for the next records
+    max_latency = args.max_latency if '-' in inputs else None
+    start = time.perf_counter()
+    if args.dry_run is not None:
+        # Write the raw PPLA stream instead of printing, e.g. to check throughput or inspect the output
+        out = sys.stdout.buffer if args.dry_run == '-' else open(args.dry_run, 'wb')
+
+        def write(data):
+            # stream_labels already batches, flush so the data does not wait in the file's buffer
+            out.write(data)
+            out.flush()
+
+        try:
+            count, size = stream_labels(layout, records, write, args.buffer_size, max_latency)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+    else:
+        from printer import Printer
+        from transport import BackgroundWriter
+        with Printer(args.vendor_id, args.product_id) as p, BackgroundWriter(p) as writer:
+            count, size = stream_labels(layout, records, writer.send, args.buffer_size, max_latency)
+    seconds = time.perf_counter() - start
+    print('{} labels, {} bytes in {:.3f} s ({:.0f} labels/s)'.format(
+        count, size, seconds, count / seconds if seconds > 0 else 0), file=sys.stderr)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Argox Label Printer Tool')
     parser.add_argument('--product-id', type=int, help='Product ID of the printer', default=0x032a)
     parser.add_argument('--vendor-id', type=int, help='Vendor ID of the printer', default=0x1664)
+    parser.add_argument('--graphics-cache', help='File remembering which graphics are stored on the printer', default='.ppla_graphics.json')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('demo', help='Print the demo label (the default)')
+    print_parser = commands.add_parser('print', help='Print a label per record of CSV or JSONL input')
+    print_parser.add_argument('layout', help='JSON file describing the label layout')
+    print_parser.add_argument('input', nargs='*', help='CSV or JSONL files, - or none for stdin')
+    print_parser.add_argument('--format', choices=['csv', 'jsonl'], help='Input format, by file extension if not given (stdin: csv)')
+    print_parser.add_argument('--dry-run', metavar='FILE', help='Write the PPLA data to FILE (- for stdout) instead of printing')
+    print_parser.add_argument('--buffer-size', type=int, help='Bytes sent to the printer at once', default=64 * 1024)
+    print_parser.add_argument('--max-latency', type=float, help='Seconds a label read from stdin may wait before it is sent', default=0.1)
     args = parser.parse_args()
 
-    # find our device
-    with Printer(args.vendor_id, args.product_id) as p:
-        print(p.get_device_id())
-        print(p.get_port_status())
-        print(p.soft_reset())
-
-        tux_hex = ppla_hex(Image.open('tux.jpg'))
-
-        ppla = PPLA()
-        ppla.clear_memory(memory='ram')
-        ppla.set_transfer_type('direct-thermal')
-        ppla.set_label_length_inch(2.65)
-        ppla.download_graphics('TUX', ppla_hex=tux_hex, memory='ram')
-        ppla.enter_label_mode()
-        ppla.label_set_pixel_size()
-        ppla.label_graphic(100, 16, 'TUX')
-        ppla.label_text(100, 2, 'Hello World!', font='asd-12')
-        ppla.label_barcode(260, 40, 'A' + 'TUX', barcode_type='code-128', orientation='landscape')
-        ppla.label_end_job()
-
-        # perform print
-        p.send(ppla.get_bytes())
+    try:
+        if args.command == 'print':
+            print_records(args)
+        else:
+            from printer import Printer
+            with Printer(args.vendor_id, args.product_id) as p:
+                print_demo_label(p, args)
+    except (RuntimeError, ValueError, OSError) as e:
+        error(str(e))
+
 
 if __name__ == '__main__':
     main()
-
-
-
-
@@ -0,0 +1,74 @@
+import functools
+import threading
+import time
+
+# Instrumented code checks this flag first, so instrumentation costs next to nothing while disabled
+enabled = False
+
+_lock = threading.Lock()
+_stats = {}
+_exporters = []
+
+
+def enable(exporter=None):
+    global enabled
+    if exporter is not None:
+        add_exporter(exporter)
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def add_exporter(exporter):
+    # exporter(stage, seconds, size, printer) is called for every recorded event
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    _exporters.remove(exporter)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def record(stage, seconds=0.0, size=0, printer=None):
+    key = stage if printer is None else '{}[{}]'.format(stage, printer)
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = {'calls': 0, 'seconds': 0.0, 'bytes': 0}
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += size
+    for exporter in _exporters:
+        exporter(stage, seconds, size, printer)
+
+
+def timed(stage, size=len):
+    # Decorator recording the time of each call, and size(result) as the byte count
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            record(stage, time.perf_counter() - start, size(result) if size is not None else 0)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    with _lock:
+        return {
+            key: dict(stats,
+                      bytes_per_call=stats['bytes'] / stats['calls'],
+                      bytes_per_second=stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else None)
+            for key, stats in _stats.items()
+        }
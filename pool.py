@@ -0,0 +1,115 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from printer import Printer
+
+
+class _Job:
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.future = concurrent.futures.Future()
+        self.failed_on = set()
+
+
+class PrinterPool:
+    # Keeps every attached printer with the given ids open and feeds them from one shared job queue. Each printer has
+    # a worker thread that takes the next job as soon as its printer is idle and healthy. A job that fails is put back
+    # for another printer, until it failed on every printer or max_attempts times.
+
+    def __init__(self, vendor_id, product_id, printers=None, max_attempts=3, status_interval=1.0):
+        self._vendor_id = vendor_id
+        self._product_id = product_id
+        self._printers = printers
+        self._max_attempts = max_attempts
+        self._status_interval = status_interval
+        self._queue = queue.Queue()
+        self._threads = []
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self._printers is None:
+            self._printers = Printer.find_all(self._vendor_id, self._product_id)
+        if not self._printers:
+            raise RuntimeError('Device not found')
+        for printer in self._printers:
+            printer.open()
+            self._stats[printer.location] = {'jobs': 0, 'failures': 0, 'bytes_sent': 0, 'seconds': 0.0}
+            thread = threading.Thread(target=self._run, args=(printer,), name='ppla-pool-' + printer.location, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        self._closed.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        while not self._queue.empty():
+            job = self._queue.get()
+            if job is not None:
+                job.future.set_exception(RuntimeError('Printer pool was closed before the job was sent'))
+        for printer in self._printers or []:
+            printer.close()
+
+    def submit(self, data):
+        if self._closed.is_set():
+            raise RuntimeError('Printer pool is closed')
+        job = _Job(data)
+        self._queue.put(job)
+        return job.future
+
+    def _is_healthy(self, printer):
+        try:
+            status = printer.get_port_status()
+        except Exception:
+            return False
+        return status['select'] and not status['paper_empty'] and not status['error']
+
+    def _run(self, printer):
+        stats = self._stats[printer.location]
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if printer.location in job.failed_on or not self._is_healthy(printer):
+                # Leave the job to another printer and check again later
+                self._queue.put(job)
+                self._closed.wait(self._status_interval)
+                continue
+            start = time.perf_counter()
+            try:
+                printer.send(job.data)
+            except Exception as e:
+                with self._lock:
+                    stats['failures'] += 1
+                job.failed_on.add(printer.location)
+                if len(job.failed_on) >= min(self._max_attempts, len(self._printers)):
+                    job.future.set_exception(e)
+                else:
+                    self._queue.put(job)
+                # Give the other printers a chance before this one takes the next job
+                self._closed.wait(self._status_interval)
+                continue
+            with self._lock:
+                stats['jobs'] += 1
+                stats['bytes_sent'] += len(job.data)
+                stats['seconds'] += time.perf_counter() - start
+            job.future.set_result(printer.location)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                location: dict(stats, bytes_per_second=stats['bytes_sent'] / stats['seconds'] if stats['seconds'] > 0 else None)
+                for location, stats in self._stats.items()
+            }
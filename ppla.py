@@ -1,8 +1,12 @@
 
+from __future__ import annotations
 import sys
 import re
+import io
+import itertools
 import datetime
-from PIL import Image, ImageOps
+import time
+import metrics
 
 
 def eprint(*args, **kwargs):
@@ -29,9 +33,122 @@ PPLA_HEX_MAP = [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0xea
                 0xdf]
 
 
+# Lookup table from a packed PIL '1' byte (set bit = white) to the PPLA encoded byte (set bit = black)
+_PPLA_HEX_TABLE = bytes(PPLA_HEX_MAP[byte ^ 0xFF] for byte in range(256))
+# Inverse of PPLA_HEX_MAP, from an encoded byte back to the pixel byte (set bit = black)
+_PPLA_HEX_INVERSE = bytes(PPLA_HEX_MAP.index(byte) for byte in range(256))
+
+
+def _prepare_image(image : Image):
+    # PIL is only imported once an image is encoded, so label-only programs start faster
+    from PIL import ImageOps
+    image = image.convert('1')
+    return ImageOps.mirror(image.rotate(180))
+
+
+# Zero padded decimal numbers as used for coordinates and sizes in the field records
+_FOUR_DIGITS = [b'%04d' % value for value in range(10000)]
+_THREE_DIGITS = [b'%03d' % value for value in range(1000)]
+
+# Encoded field record prefixes by their options, filled in as they are used
+_FIELD_PREFIXES = {}
+
+
+def _digits(value, table):
+    if type(value) is int and 0 <= value < len(table):
+        return table[value]
+    return '{:0{}d}'.format(value, len(table[0])).encode('ascii')
+
+
+@metrics.timed('image')
 def ppla_hex(image : Image):
+    image = _prepare_image(image)
+    width, height = image.size
+    row_bytes = width // 8
+    stride = (width + 7) // 8
+    raster = image.tobytes()
+    header = b'80' + '{:02x}'.format(row_bytes).encode('ascii')
+    rows = [header + raster[offset:offset + row_bytes].translate(_PPLA_HEX_TABLE).hex().encode('ascii')
+            for offset in range(0, stride * height, stride)]
+    result = bytearray(b''.join(rows))
+    result += b'FFFF'
+    return result
+
+
+@metrics.timed('image')
+def ppla_hex_compressed(image : Image):
+    # Every record starts with 0x80 plus the number of times the row is repeated after the first one, followed by
+    # the number of data bytes. Rows are white past their data, so trailing white bytes are dropped and blank rows
+    # become empty records that collapse into a single repeated one.
+    image = _prepare_image(image)
+    width, height = image.size
+    row_bytes = width // 8
+    stride = (width + 7) // 8
+    raster = image.tobytes()
+    rows = (raster[offset:offset + row_bytes].translate(_PPLA_HEX_TABLE).rstrip(b'\x00')
+            for offset in range(0, stride * height, stride))
+    result = bytearray()
+    for row, repeats in itertools.groupby(rows):
+        count = sum(1 for _ in repeats)
+        record = '{:02x}'.format(len(row)).encode('ascii') + row.hex().encode('ascii')
+        while count > 0:
+            repeat = min(count, 0x7F)
+            result += '{:02x}'.format(0x80 + repeat - 1).encode('ascii') + record
+            count -= repeat
+    result += b'FFFF'
+    return result
+
+
+def encode_image(image : Image, compress=False):
+    return ppla_hex_compressed(image) if compress else ppla_hex(image)
+
+
+def decode_ppla_hex(data, row_bytes=None):
+    # Returns the pixel rows (set bit = black) in transfer order, padded with white to row_bytes
+    data = bytes(data)
+    rows = []
+    offset = 0
+    while offset + 4 <= len(data):
+        first = int(data[offset:offset + 2], 16)
+        if first == 0xFF:
+            break
+        count = int(data[offset + 2:offset + 4], 16)
+        if first < 0x80 or offset + 4 + 2 * count > len(data):
+            raise ValueError('Invalid graphics record at offset {}'.format(offset))
+        row = bytes.fromhex(data[offset + 4:offset + 4 + 2 * count].decode('ascii')).translate(_PPLA_HEX_INVERSE)
+        rows += [row] * (first - 0x80 + 1)
+        offset += 4 + 2 * count
+    else:
+        raise ValueError('Graphics data is missing the FFFF terminator')
+    if row_bytes is None:
+        row_bytes = max((len(row) for row in rows), default=0)
+    return [row.ljust(row_bytes, b'\x00') for row in rows]
+
+
+def compression_ratio(image : Image):
+    plain = ppla_hex(image)
+    compressed = ppla_hex_compressed(image)
+    if decode_ppla_hex(compressed, image.size[0] // 8) != decode_ppla_hex(plain):
+        raise RuntimeError('Compressed graphics do not decode to the original image')
+    return len(plain) / len(compressed)
+
+
+@metrics.timed('image')
+def ppla_binary(image : Image, image_format='bmp'):
+    # Binary images are sent as a plain 1 bit file. The file header carries its own length, so the printer
+    # reads the payload verbatim and control bytes inside it need no escaping. Like ppla_hex, columns past the last
+    # multiple of 8 are left out, so all encodings print the same.
     image = image.convert('1')
-    image = ImageOps.mirror(image.rotate(180))
+    if image.size[0] % 8:
+        image = image.crop((0, 0, image.size[0] - image.size[0] % 8, image.size[1]))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format.upper())
+    return buffer.getvalue()
+
+
+def ppla_hex_reference(image : Image):
+    # Straightforward per-pixel encoder. Kept as the reference ppla_hex is checked and benchmarked against.
+    image = _prepare_image(image)
     width, height = image.size
     usable_width = width - (width % 8)
     result = bytearray()
@@ -47,6 +164,46 @@ def ppla_hex(image : Image):
     return result
 
 
+class Serial:
+    # A numeric field that counts from start by step from label to label, zero padded to width and optionally
+    # wrapping around to minimum after maximum. prefix is printed in front of the number.
+
+    def __init__(self, start, step=1, width=0, minimum=0, maximum=None, prefix=''):
+        if maximum is not None and not minimum <= start <= maximum:
+            raise ValueError('Serial start must be between minimum and maximum')
+        self.start = start
+        self.step = step
+        self.width = width
+        self.minimum = minimum
+        self.maximum = maximum
+        self.prefix = prefix
+        # Label the fields are currently encoded for, and whether the printer does the counting
+        self.index = 0
+        self.printer_side = False
+
+    def _cycle(self, index):
+        if self.maximum is None:
+            return 0
+        return (self.start - self.minimum + self.step * index) // (self.maximum - self.minimum + 1)
+
+    def value(self, index=None):
+        index = self.index if index is None else index
+        number = self.start + self.step * index
+        if self.maximum is not None:
+            number = self.minimum + (number - self.minimum) % (self.maximum - self.minimum + 1)
+        if number < 0:
+            raise ValueError('Serial went below zero')
+        return self.prefix + '{:0{}d}'.format(number, self.width)
+
+    def wraps_at(self, index):
+        # The printer cannot wrap around, so a new format has to be sent when this is true
+        return self._cycle(index) != self._cycle(index - 1)
+
+    def restarts_at(self, index):
+        # The printer also keeps the number of digits when counting, so a new format is needed when it changes too
+        return self.wraps_at(index) or len(self.value(index)) != len(self.value(index - 1))
+
+
 class PPLA:
     SOH = b'\x01'
     STX = b'\x02'
@@ -163,6 +320,17 @@ class PPLA:
         'flash': b'B'
     }
 
+    _max_quantity = 9999
+
+    # The increment record (+nn / -nn) has two digits
+    _min_increment = 1
+    _max_increment = 99
+
+    _image_formats = {
+        'bmp': b'B',
+        'pcx': b'P',
+    }
+
     def _check_in_options(self, selection, option_dict):
         if selection in option_dict:
             return option_dict[selection]
@@ -171,8 +339,25 @@ class PPLA:
             print('Valid selections are: ' + ', '.join(option_dict.keys()))
             raise ValueError('Invalid selection')
 
+    def _check_name(self, name):
+        name = name.encode('ascii')
+        assert len(name) <= 16
+        # The name is terminated by CR, control characters in it would corrupt the command stream
+        assert all(0x20 <= c < 0x7f for c in name)
+        return name
+
+    # Subclasses that do not keep their data turn this off, the boundaries list grows with every label
+    _keep_label_boundaries = True
+
     def __init__(self):
         self._data = bytearray()
+        self._label_start = None
+        self._label_offset = None
+        # (start, end) offsets of every label block, for resuming a transfer at a label boundary
+        self._label_boundaries = []
+
+    def _data_size(self):
+        return len(self._data)
 
     def reset(self):
         self._data += self.SOH + b'#\r'
@@ -272,6 +457,9 @@ class PPLA:
         return self
 
     def enter_label_mode(self):
+        self._label_offset = self._data_size()
+        if metrics.enabled:
+            self._label_start = (time.perf_counter(), self._label_offset)
         self._data += self.STX + b'L\r'
         return self
 
@@ -315,11 +503,31 @@ class PPLA:
     def measurements_in_inches(self):
         self._data += self.STX + b'n\r'
 
-    def download_graphics(self, name, ppla_hex, memory='ram'):
+    def download_graphics(self, name, ppla_hex=None, memory='ram', image=None, compress=False):
+        if image is not None:
+            ppla_hex = encode_image(image, compress=compress)
         memory = self._check_in_options(memory, self._memory_types)
-        name = name.encode('ascii')
-        assert len(name) <= 16
+        name = self._check_name(name)
         self._data += self.STX + b'I' + memory + b'F' + name + b'\r' + ppla_hex + b'\r'
+        if metrics.enabled:
+            metrics.record('graphics', size=len(ppla_hex))
+
+    def download_graphics_binary(self, name, data=None, memory='ram', image=None, image_format='bmp'):
+        if image is not None:
+            data = ppla_binary(image, image_format=image_format)
+        memory = self._check_in_options(memory, self._memory_types)
+        image_format = self._check_in_options(image_format, self._image_formats)
+        name = self._check_name(name)
+        self._data += self.STX + b'I' + memory + image_format + name + b'\r' + data
+        if metrics.enabled:
+            metrics.record('graphics', size=len(data))
+        return self
+
+    def delete_graphics(self, name, memory='ram'):
+        memory = self._check_in_options(memory, self._memory_types)
+        name = self._check_name(name)
+        self._data += self.STX + b'x' + memory + b'G' + name + b'\r'
+        return self
 
     def label_set_cut_by_amount(self, amount):
         amount = '{:04d}'.format(int(amount * 100))
@@ -340,6 +548,33 @@ class PPLA:
 
     def label_end_job(self):
         self._data += b'E\r'
+        if self._label_offset is not None:
+            if self._keep_label_boundaries:
+                self._label_boundaries.append((self._label_offset, self._data_size()))
+            self._label_offset = None
+        if metrics.enabled and self._label_start is not None:
+            start, size = self._label_start
+            metrics.record('label', time.perf_counter() - start, self._data_size() - size)
+            self._label_start = None
+        return self
+
+    def label_terminate_without_printing(self):
+        self._data += b'X\r'
+        return self
+
+    def label_make_previous_replaceable(self):
+        self._data += b'U\r'
+        return self
+
+    def label_store_format(self, name, memory='ram'):
+        memory = self._check_in_options(memory, self._memory_types)
+        name = self._check_name(name)
+        self._data += b's' + memory + name + b'\r'
+        return self
+
+    def label_recall_format(self, name):
+        name = self._check_name(name)
+        self._data += b'r' + name + b'\r'
         return self
 
     def label_store_previous_to_global_register(self):
@@ -365,6 +600,54 @@ class PPLA:
         quantity = '{:04d}'.format(quantity)
         self._data += b'Q' + quantity.encode('ascii') + b'\r'
 
+    def label_increment_previous_field(self, step=1):
+        if not self._min_increment <= abs(step) <= self._max_increment:
+            raise ValueError('Field increment must be between {} and {}'.format(self._min_increment, self._max_increment))
+        sign = b'+' if step >= 0 else b'-'
+        step = '{:02d}'.format(abs(step))
+        self._data += sign + step.encode('ascii') + b'\r'
+        return self
+
+    def label_serial_text(self, x, y, serial, *args, **kwargs):
+        self.label_text(x, y, serial.value(), *args, **kwargs)
+        if serial.printer_side:
+            self.label_increment_previous_field(serial.step)
+        return self
+
+    def label_serial_barcode(self, x, y, serial, *args, **kwargs):
+        self.label_barcode(x, y, serial.value(), *args, **kwargs)
+        if serial.printer_side:
+            self.label_increment_previous_field(serial.step)
+        return self
+
+    def serial_labels(self, build, count, serials, printer_side=True):
+        # Prints count labels where the serials count up. build(ppla) adds the label fields, using label_serial_text
+        # and label_serial_barcode for the serials. With printer_side, the printer counts and the run is sent as one
+        # format with a quantity (split where a serial wraps around, changes its number of digits or the quantity
+        # limit is reached), otherwise
+        # every label is sent in full. Steps the printer cannot count by (see label_increment_previous_field) fall back
+        # to sending every label.
+        printer_side = printer_side and all(self._min_increment <= abs(serial.step) <= self._max_increment
+                                            for serial in serials)
+        for serial in serials:
+            serial.printer_side = printer_side
+        index = 0
+        while index < count:
+            quantity = 1
+            if printer_side:
+                while (index + quantity < count and quantity < self._max_quantity
+                       and not any(serial.restarts_at(index + quantity) for serial in serials)):
+                    quantity += 1
+            for serial in serials:
+                serial.index = index
+            self.enter_label_mode()
+            build(self)
+            if quantity > 1:
+                self.label_set_quantity(quantity)
+            self.label_end_job()
+            index += quantity
+        return self
+
     def label_set_vertical_offset_inch(self, offset):
         offset = '{:04d}'.format(int(offset * 100))
         self._data += b'V' + offset.encode('ascii') + b'\r'
@@ -375,62 +658,104 @@ class PPLA:
     def label_date_and_time(self, format):
         self._data += b'T' + format.encode('ascii') + b'\r'
 
-    def label_text(self, x, y, data, orientation='portrait', font='font-4', horizontal_scale=1, vertical_scale=1):
+    def _text_prefix(self, orientation, font, horizontal_scale, vertical_scale):
+        key = ('text', orientation, font, horizontal_scale, vertical_scale)
+        prefix = _FIELD_PREFIXES.get(key)
+        if prefix is None:
+            orientation = self._check_in_options(orientation, self._orientations)
+            font_type, font_subtype = self._check_in_options(font, self._fonts)
+            h_scale = self._check_in_options(horizontal_scale, self._scales)
+            v_scale = self._check_in_options(vertical_scale, self._scales)
+            prefix = _FIELD_PREFIXES[key] = orientation + font_type + h_scale + v_scale + font_subtype
+        return prefix
+
+    def _barcode_prefix(self, orientation, barcode_type, wide_bar_width, narrow_bar_width, height, human_readable):
+        key = ('barcode', orientation, barcode_type, wide_bar_width, narrow_bar_width, height, bool(human_readable))
+        prefix = _FIELD_PREFIXES.get(key)
+        if prefix is None:
+            orientation = self._check_in_options(orientation, self._orientations)
+            barcode_type_readable, barcode_type_non_readable = self._check_in_options(barcode_type, self._barcode_types)
+            height = '{:03d}'.format(int(height)).encode('ascii')
+            wide_bar_width = '{:01}'.format(int(wide_bar_width)).encode('ascii')
+            narrow_bar_width = '{:01d}'.format(int(narrow_bar_width)).encode('ascii')
+
+            barcode_type = barcode_type_readable if human_readable else barcode_type_non_readable
+            if barcode_type is None:
+                raise ValueError('Invalid barcode type')
+            prefix = _FIELD_PREFIXES[key] = orientation + barcode_type + wide_bar_width + narrow_bar_width + height
+        return prefix
+
+    def _shape_prefix(self, orientation, shape):
+        key = (shape, orientation)
+        prefix = _FIELD_PREFIXES.get(key)
+        if prefix is None:
+            prefix = _FIELD_PREFIXES[key] = self._check_in_options(orientation, self._orientations) + shape
+        return prefix
+
+    def _encode_text(self, x, y, data, orientation='portrait', font='font-4', horizontal_scale=1, vertical_scale=1):
         if isinstance(data, str):
             data = data.encode('ascii')
-        orientation = self._check_in_options(orientation, self._orientations)
-        font_type, font_subtype = self._check_in_options(font, self._fonts)
-        h_scale = self._check_in_options(horizontal_scale, self._scales)
-        v_scale = self._check_in_options(vertical_scale, self._scales)
+        prefix = self._text_prefix(orientation, font, horizontal_scale, vertical_scale)
+        return b''.join((prefix, _digits(y, _FOUR_DIGITS), _digits(x, _FOUR_DIGITS), data, b'\r'))
 
-        x = '{:04d}'.format(x).encode('ascii')
-        y = '{:04d}'.format(y).encode('ascii')
+    def _encode_barcode(self, x, y, data, orientation='portrait', barcode_type='code-128', wide_bar_width=5, narrow_bar_width=2, height=0, human_readable=False):
+        prefix = self._barcode_prefix(orientation, barcode_type, wide_bar_width, narrow_bar_width, height, human_readable)
+        return b''.join((prefix, _digits(y, _FOUR_DIGITS), _digits(x, _FOUR_DIGITS), data.encode('ascii'), b'\r'))
 
-        self._data += orientation + font_type + h_scale + v_scale + font_subtype + y + x + data + b'\r'
-        return self
+    def _encode_box(self, x, y, width, height, orientation='portrait', top_bottom_thickness=2, left_right_thickness=2):
+        return b''.join((self._shape_prefix(orientation, b'X11000'), _digits(y, _FOUR_DIGITS), _digits(x, _FOUR_DIGITS),
+                         b'B', _digits(width, _THREE_DIGITS), _digits(height, _THREE_DIGITS),
+                         _digits(int(top_bottom_thickness), _THREE_DIGITS), _digits(int(left_right_thickness), _THREE_DIGITS), b'\r'))
 
-    def label_barcode(self, x, y, data, orientation='portrait', barcode_type='code-128', wide_bar_width=5, narrow_bar_width=2, height=0, human_readable=False):
-        orientation = self._check_in_options(orientation, self._orientations)
-        barcode_type_readable, barcode_type_non_readable = self._check_in_options(barcode_type, self._barcode_types)
-        x = '{:04d}'.format(x).encode('ascii')
-        y = '{:04d}'.format(y).encode('ascii')
-        height = '{:03d}'.format(int(height)).encode('ascii')
-        wide_bar_width = '{:01}'.format(int(wide_bar_width)).encode('ascii')
-        narrow_bar_width = '{:01d}'.format(int(narrow_bar_width)).encode('ascii')
+    def _encode_line(self, x, y, width, height, orientation='portrait'):
+        return b''.join((self._shape_prefix(orientation, b'X11000'), _digits(y, _FOUR_DIGITS), _digits(x, _FOUR_DIGITS),
+                         b'L', _digits(width, _THREE_DIGITS), _digits(height, _THREE_DIGITS), b'\r'))
+
+    def _encode_graphic(self, x, y, name, orientation='portrait'):
+        return b''.join((self._shape_prefix(orientation, b'Y11000'), _digits(y, _FOUR_DIGITS), _digits(x, _FOUR_DIGITS),
+                         name.encode('ascii'), b'\r'))
 
-        barcode_type = barcode_type_readable if human_readable else barcode_type_non_readable
-        if barcode_type is None:
-            raise ValueError('Invalid barcode type')
+    def label_text(self, x, y, data, orientation='portrait', font='font-4', horizontal_scale=1, vertical_scale=1):
+        self._data += self._encode_text(x, y, data, orientation, font, horizontal_scale, vertical_scale)
+        return self
 
-        self._data += orientation + barcode_type + wide_bar_width + narrow_bar_width + height + y + x + data.encode('ascii') + b'\r'
+    def label_barcode(self, x, y, data, orientation='portrait', barcode_type='code-128', wide_bar_width=5, narrow_bar_width=2, height=0, human_readable=False):
+        self._data += self._encode_barcode(x, y, data, orientation, barcode_type, wide_bar_width, narrow_bar_width, height, human_readable)
         return self
 
     def label_box(self, x, y, width, height, orientation='portrait', top_bottom_thickness=2, left_right_thickness=2):
-        orientation = self._check_in_options(orientation, self._orientations)
-        top_bottom_thickness = '{:03d}'.format(int(top_bottom_thickness)).encode('ascii')
-        left_right_thickness = '{:03d}'.format(int(left_right_thickness)).encode('ascii')
-        x = '{:04d}'.format(x).encode('ascii')
-        y = '{:04d}'.format(y).encode('ascii')
-        width = '{:03d}'.format(width).encode('ascii')
-        height = '{:03d}'.format(height).encode('ascii')
-        self._data += orientation + b'X11000' + y + x + b'B' + width + height + top_bottom_thickness + left_right_thickness + b'\r'
+        self._data += self._encode_box(x, y, width, height, orientation, top_bottom_thickness, left_right_thickness)
         return self
 
     def label_line(self, x, y, width, height, orientation='portrait'):
-        orientation = self._check_in_options(orientation, self._orientations)
-        x = '{:04d}'.format(x).encode('ascii')
-        y = '{:04d}'.format(y).encode('ascii')
-        width = '{:03d}'.format(width).encode('ascii')
-        height = '{:03d}'.format(height).encode('ascii')
-        self._data += orientation + b'X11000' + y + x + b'L' + width + height + b'\r'
+        self._data += self._encode_line(x, y, width, height, orientation)
         return self
 
     def label_graphic(self, x, y, name, orientation='portrait'):
-        orientation = self._check_in_options(orientation, self._orientations)
-        x = '{:04d}'.format(x).encode('ascii')
-        y = '{:04d}'.format(y).encode('ascii')
-        self._data += orientation + b'Y11000' + y + x + name.encode('ascii') + b'\r'
+        self._data += self._encode_graphic(x, y, name, orientation)
+        return self
+
+    _field_encoders = {
+        'text': _encode_text,
+        'barcode': _encode_barcode,
+        'box': _encode_box,
+        'line': _encode_line,
+        'graphic': _encode_graphic,
+    }
+
+    def add_fields(self, fields):
+        # Adds many field records at once. Each field is a dict with 'type' (text, barcode, box, line or graphic)
+        # and the arguments of the matching label_* method, e.g. {'type': 'text', 'x': 10, 'y': 20, 'data': 'Hi'}
+        records = []
+        for field in fields:
+            field = dict(field)
+            encode = self._check_in_options(field.pop('type'), self._field_encoders)
+            records.append(encode(self, **field))
+        self._data += b''.join(records)
         return self
 
     def get_bytes(self):
         return self._data
+
+    def get_label_boundaries(self):
+        return list(self._label_boundaries)
@@ -0,0 +1,175 @@
+import array
+import time
+import usb.core
+import usb.util
+import metrics
+
+
+def transfer_buffer(data):
+    # pyusb passes array('B') through as it is but copies anything else byte by byte (memoryviews) or again (bytes),
+    # so convert the data once and slice the array, which copies with memcpy
+    if isinstance(data, array.array) and data.typecode == 'B':
+        return data
+    # frombytes takes any buffer (bytes, bytearray, memoryview) with a single copy
+    buffer = array.array('B')
+    buffer.frombytes(data)
+    return buffer
+
+
+class TransferError(RuntimeError):
+    # A bulk write failed after offset bytes of the data were accepted by the printer
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+class Printer:
+    CLASS_REQUEST_GET_DEVICE_ID = 0x00
+    CLASS_REQUEST_GET_PORT_STATUS = 0x01
+    CLASS_REQUEST_SOFT_RESET = 0x02
+
+    def __init__(self, vendor_id, product_id, transfer_size=64 * 1024, timeout=5000, bus=None, address=None):
+        self._dev = None
+        self._vendor_id = vendor_id
+        self._product_id = product_id
+        # Select one of several identical printers, the first one found is used if not given
+        self._bus = bus
+        self._address = address
+        self._ep_in = None
+        self._ep_out = None
+        # Bytes per bulk write, libusb splits each write into wMaxPacketSize packets itself
+        self._transfer_size = transfer_size
+        # Timeout of each bulk write in milliseconds
+        self._timeout = timeout
+        self._bytes_sent = 0
+        self._send_seconds = 0.0
+        self._last_send_rate = None
+
+    @classmethod
+    def find_all(cls, vendor_id, product_id, **kwargs):
+        devices = usb.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id)
+        return [cls(vendor_id, product_id, bus=dev.bus, address=dev.address, **kwargs) for dev in devices]
+
+    @property
+    def location(self):
+        return '{}:{}'.format(self._bus, self._address)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        match = {}
+        if self._bus is not None:
+            match['bus'] = self._bus
+        if self._address is not None:
+            match['address'] = self._address
+        self._dev = usb.core.find(idVendor=self._vendor_id, idProduct=self._product_id, **match)
+        if self._dev is None:
+            raise RuntimeError('Device not found')
+        # Remember where the device was found, so location identifies it even if it was not selected by bus/address
+        self._bus = self._dev.bus
+        self._address = self._dev.address
+        self._dev.set_configuration()
+
+        # find endpoints
+        cfg = self._dev.get_active_configuration()
+        intf = cfg[(0, 0)]
+        self._ep_out = usb.util.find_descriptor(
+            intf,
+            # match the first OUT endpoint
+            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT
+        )
+        if self._ep_out is None:
+            raise RuntimeError('Endpoint OUT not found')
+        self._ep_in = usb.util.find_descriptor(
+            intf,
+            # match the first IN endpoint
+            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN
+        )
+        if self._ep_in is None:
+            raise RuntimeError('Endpoint IN not found')
+
+    def close(self):
+        if self._dev is not None:
+            usb.util.dispose_resources(self._dev)
+            self._dev = None
+            self._ep_in = None
+            self._ep_out = None
+
+    def _perform_class_request(self, request, value, index, length):
+        request_type = usb.util.build_request_type(
+            direction=usb.util.CTRL_IN,
+            type=usb.util.CTRL_TYPE_CLASS,
+            recipient=usb.util.CTRL_RECIPIENT_INTERFACE
+        )
+        return self._dev.ctrl_transfer(request_type, request, value, index, length)
+
+    def get_device_id(self):
+        data = self._perform_class_request(
+            self.CLASS_REQUEST_GET_DEVICE_ID,
+            value=0,
+            index=0,
+            length=64
+        )
+        return ''.join([chr(c) for c in data])
+
+    def get_port_status(self):
+        data = self._perform_class_request(
+            self.CLASS_REQUEST_GET_PORT_STATUS,
+            value=0,
+            index=0,
+            length=1
+        )
+        result = {
+            'paper_empty': bool(data[0] & (1 << 5)),
+            'select': bool(data[0] & (1 << 4)),
+            'error': not bool(data[0] & (1 << 3)),
+        }
+        return result
+
+    def soft_reset(self):
+        data = self._perform_class_request(
+            self.CLASS_REQUEST_SOFT_RESET,
+            value=0,
+            index=0,
+            length=0
+        )
+        return data
+
+    def send(self, data, transfer_size=None, timeout=None):
+        transfer_size = transfer_size or self._transfer_size
+        timeout = timeout or self._timeout
+        view = transfer_buffer(data)
+        offset = 0
+        size = len(view)
+        start = time.perf_counter()
+        while offset < size:
+            try:
+                length = self._dev.write(self._ep_out.bEndpointAddress, view[offset:offset + transfer_size], timeout)
+            except usb.core.USBError as e:
+                raise TransferError('USB bulk write error: {}'.format(e), offset) from e
+            if length <= 0:
+                raise TransferError("USB bulk write error", offset)
+            offset += length
+        seconds = time.perf_counter() - start
+        self._bytes_sent += offset
+        self._send_seconds += seconds
+        self._last_send_rate = offset / seconds if seconds > 0 else None
+        if metrics.enabled:
+            metrics.record('transfer', seconds, offset, printer=self.location)
+        return offset
+
+    def get_transfer_stats(self):
+        return {
+            'bytes_sent': self._bytes_sent,
+            'seconds': self._send_seconds,
+            'bytes_per_second': self._bytes_sent / self._send_seconds if self._send_seconds > 0 else None,
+            'last_bytes_per_second': self._last_send_rate,
+        }
+
+    def recv(self, length, timeout=None):
+        return self._ep_in.read(length, timeout or self._timeout)
@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from coalesce import coalesce_jobs
+from ppla import PPLA
+
+
+def encode_job(job):
+    # Turns a JSON job into PPLA data. A job is either {'data': '<raw PPLA>'}, one label
+    # {'fields': [...], 'quantity': n} with fields as taken by PPLA.add_fields, or {'labels': [<label>, ...]}
+    if 'data' in job:
+        return job['data'].encode('latin-1')
+    ppla = PPLA()
+    for label in job.get('labels', [job]):
+        ppla.enter_label_mode()
+        ppla.add_fields(label['fields'])
+        if label.get('quantity', 1) != 1:
+            ppla.label_set_quantity(label['quantity'])
+        ppla.label_end_job()
+    return bytes(ppla.get_bytes())
+
+
+class JobQueue:
+    # Pending jobs as one file per job in directory, named by a sequence number so they are sent in order.
+    # Files are written under a temporary name and renamed, so a crash never leaves a partial job behind.
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._jobs = []
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+            elif name.endswith('.job'):
+                self._jobs.append(int(name[:-4]))
+        self._jobs.sort()
+        self._next_id = self._jobs[-1] + 1 if self._jobs else 1
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _path(self, job_id):
+        return os.path.join(self._directory, '{:012d}.job'.format(job_id))
+
+    def put(self, data):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            path = self._path(job_id)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            self._jobs.append(job_id)
+        return job_id
+
+    def peek(self, max_bytes):
+        # The oldest jobs, at least one, up to max_bytes in total, as a list of (job id, data)
+        with self._lock:
+            job_ids = list(self._jobs)
+        result = []
+        size = 0
+        for job_id in job_ids:
+            with open(self._path(job_id), 'rb') as f:
+                data = f.read()
+            if result and size + len(data) > max_bytes:
+                break
+            result.append((job_id, data))
+            size += len(data)
+        return result
+
+    def remove(self, job_ids):
+        with self._lock:
+            for job_id in job_ids:
+                os.remove(self._path(job_id))
+                self._jobs.remove(job_id)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    # The client sends one job and shuts down its side of the connection. Data starting with '{' is a JSON job,
+    # anything else is raw PPLA. The reply is one JSON line, {"job": id} or {"error": message}.
+
+    def handle(self):
+        data = self.rfile.read()
+        try:
+            if data.lstrip()[:1] == b'{':
+                data = encode_job(json.loads(data.decode('utf-8')))
+            reply = {'job': self.server.spooler.submit(data)}
+        except Exception as e:
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class _JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Bursts of clients connecting at once would be refused with the default backlog of 5
+    request_queue_size = 128
+
+
+class Spooler:
+    # Keeps the printer open and sends the jobs of a JobQueue to it from a writer thread. Jobs that arrive within
+    # latency seconds of each other are sent as one transfer of up to max_bytes, optionally with identical consecutive
+    # labels merged into quantities. A job leaves the queue only after it has been sent, so jobs that were pending
+    # when the spooler stopped are sent after a restart (a crash during the transfer itself can print a job twice).
+    # When a transfer fails, the jobs the printer received completely (up to the offset of the TransferError) leave
+    # the queue and the rest is retried after retry_interval seconds, starting with the job it received in part.
+
+    def __init__(self, printer, queue_directory, max_bytes=256 * 1024, latency=0.05, coalesce=False,
+                 retry_interval=1.0):
+        self._printer = printer
+        self.queue = JobQueue(queue_directory)
+        self._max_bytes = max_bytes
+        self._latency = latency
+        self._coalesce = coalesce
+        self._retry_interval = retry_interval
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._server = None
+        self._thread = threading.Thread(target=self._run, name='ppla-spooler', daemon=True)
+        self.last_error = None
+        self.jobs_sent = 0
+        self.transfers = 0
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, data):
+        job_id = self.queue.put(bytes(data))
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not len(self.queue) and not self._stopping:
+                    self._wakeup.wait()
+                if not len(self.queue):
+                    return
+            # Give further jobs of a burst the chance to arrive and join this transfer
+            if not self._stopping:
+                time.sleep(self._latency)
+            jobs = self.queue.peek(self._max_bytes)
+            if self._coalesce:
+                data, ends = coalesce_jobs([job for _, job in jobs])
+            else:
+                data = b''.join(job for _, job in jobs)
+                ends = list(itertools.accumulate(len(job) for _, job in jobs))
+            try:
+                self._printer.send(data)
+            except Exception as e:
+                self.last_error = e
+                # Printer.send raises a TransferError with the offset the printer accepted
+                offset = getattr(e, 'offset', 0)
+                sent = [job_id for (job_id, _), end in zip(jobs, ends) if end <= offset]
+                if sent:
+                    self.queue.remove(sent)
+                    self.jobs_sent += len(sent)
+                    self.bytes_sent += offset
+                with self._wakeup:
+                    if self._stopping:
+                        return
+                    self._wakeup.wait(self._retry_interval)
+                continue
+            self.queue.remove([job_id for job_id, _ in jobs])
+            self.jobs_sent += len(jobs)
+            self.transfers += 1
+            self.bytes_sent += len(data)
+
+    def serve(self, socket_path):
+        # Accepts jobs on a Unix socket until close() is called
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _JobServer(socket_path, _JobHandler)
+        server.spooler = self
+        self._server = server
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+    def serve_in_background(self, socket_path):
+        thread = threading.Thread(target=self.serve, args=(socket_path,), name='ppla-spooler-server', daemon=True)
+        thread.start()
+        while self._server is None:
+            time.sleep(0.01)
+        return thread
+
+    def flush(self, timeout=None):
+        # Waits until all queued jobs are sent, returns whether they were
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self.queue):
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        # Stops accepting jobs and returns once the writer is done. Jobs it could not send stay queued on disk.
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def submit_job(socket_path, job, timeout=10):
+    # Sends a job (raw PPLA bytes or a JSON job dict) to a running spooler and returns its job id
+    if isinstance(job, dict):
+        job = json.dumps(job).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(bytes(job))
+        s.shutdown(socket.SHUT_WR)
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    reply = json.loads(reply.decode('utf-8'))
+    if 'error' in reply:
+        raise RuntimeError('Spooler rejected job: {}'.format(reply['error']))
+    return reply['job']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Argox Label Printer Spooler')
+    parser.add_argument('--product-id', type=int, help='Product ID of the printer', default=0x032a)
+    parser.add_argument('--vendor-id', type=int, help='Vendor ID of the printer', default=0x1664)
+    parser.add_argument('--socket', help='Unix socket to accept jobs on', default='/tmp/ppla-spooler.sock')
+    parser.add_argument('--queue', help='Directory holding the pending jobs', default='.ppla_spool')
+    parser.add_argument('--max-bytes', type=int, help='Largest batched transfer in bytes', default=256 * 1024)
+    parser.add_argument('--latency', type=float, help='Seconds to wait for more jobs before sending', default=0.05)
+    parser.add_argument('--coalesce', action='store_true', help='Merge identical consecutive labels into quantities')
+    parser.add_argument('--fake', action='store_true', help='Spool to a simulated printer instead of USB')
+    args = parser.parse_args()
+
+    if args.fake:
+        from fakeusb import fake_printer
+        printer = fake_printer()
+    else:
+        from printer import Printer
+        printer = Printer(args.vendor_id, args.product_id)
+        printer.open()
+    spooler = Spooler(printer, args.queue, max_bytes=args.max_bytes, latency=args.latency, coalesce=args.coalesce)
+    try:
+        spooler.start()
+        spooler.serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spooler.close()
+        if not args.fake:
+            printer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import re
+import time
+import metrics
+from ppla import PPLA
+
+
+def _reply_text(reply):
+    if not isinstance(reply, str):
+        reply = bytes(reply).decode('ascii', errors='replace')
+    return reply
+
+
+def _reply_lines(reply):
+    lines = [line.strip(' \x01\x02') for line in re.split(r'[\r\n]+', _reply_text(reply))]
+    return [line for line in lines if line]
+
+
+def parse_status(reply):
+    # SOH A replies with eight Y/N flags
+    flags = re.search(r'[YN]{8}', _reply_text(reply))
+    if flags is None:
+        raise ValueError('Invalid status reply: {!r}'.format(reply))
+    flags = [flag == 'Y' for flag in flags.group(0)]
+    return {
+        'interpreter_busy': flags[0],
+        'paper_out': flags[1],
+        'ribbon_out': flags[2],
+        'printing_batch': flags[3],
+        'busy_printing': flags[4],
+        'paused': flags[5],
+        'label_presented': flags[6],
+    }
+
+
+def parse_printer_version(reply):
+    lines = _reply_lines(reply)
+    version = re.search(r'\d+(\.\d+)+', ' '.join(lines))
+    return {
+        'version': version.group(0) if version else None,
+        'text': '\n'.join(lines),
+    }
+
+
+def parse_memory_status(reply):
+    # The memory inquiry replies with one line per stored object followed by the amount of free memory.
+    # The exact wording varies between firmwares, so only rely on the line holding 'avail' or 'free' and a number.
+    names = []
+    free_bytes = None
+    for line in _reply_lines(reply):
+        match = re.search(r'(\d+)', line)
+        if match and re.search(r'avail|free', line, re.IGNORECASE):
+            free_bytes = int(match.group(1))
+        else:
+            names.append(line.split()[0].upper())
+    return {
+        'names': names,
+        'free_bytes': free_bytes,
+    }
+
+
+def parse_system_configuration(reply):
+    # One setting per line, either 'NAME: VALUE' or 'NAME VALUE'
+    result = {}
+    for line in _reply_lines(reply):
+        key, _, value = line.partition(':') if ':' in line else line.rpartition(' ')
+        result[key.strip().lower()] = value.strip()
+    return result
+
+
+class StatusMonitor:
+    # Sends data in chunks and asks the printer for its status (SOH A, which is handled even while data is queued)
+    # before each chunk. Sending pauses while the printer is out of paper or ribbon, paused or has a port error
+    # (e.g. head up), and resumes as soon as it is ready again. The printer keeps receiving while it prints, so a busy
+    # interpreter only pauses sending with wait_while_busy, as a stand-in for printers whose buffer overruns.
+
+    def __init__(self, printer, chunk_size=16 * 1024, poll_interval=0.05, max_wait=None, wait_while_busy=False):
+        self._printer = printer
+        self._wait_while_busy = wait_while_busy
+        self._chunk_size = chunk_size
+        self._poll_interval = poll_interval
+        self._max_wait = max_wait
+        self._status_request = bytes(PPLA().request_status().get_bytes())
+        self.status = None
+
+    def get_status(self):
+        self._printer.send(self._status_request)
+        status = parse_status(self._printer.recv(64))
+        if hasattr(self._printer, 'get_port_status'):
+            status['port_error'] = self._printer.get_port_status()['error']
+        self.status = status
+        return status
+
+    def is_ready(self, status):
+        return not (status['paper_out'] or status['ribbon_out'] or status['paused'] or status.get('port_error', False)
+                    or (self._wait_while_busy and status['interpreter_busy']))
+
+    def wait_until_ready(self):
+        start = time.monotonic()
+        while not self.is_ready(self.get_status()):
+            if self._max_wait is not None and time.monotonic() - start > self._max_wait:
+                raise RuntimeError('Printer not ready: {}'.format(self.status))
+            time.sleep(self._poll_interval)
+        if metrics.enabled:
+            metrics.record('wait', time.monotonic() - start)
+
+    def send(self, data):
+        # bytes slices, as pyusb copies memoryviews byte by byte
+        view = bytes(data)
+        offset = 0
+        while offset < len(view):
+            self.wait_until_ready()
+            offset += self._printer.send(view[offset:offset + self._chunk_size])
+        return offset
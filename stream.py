@@ -0,0 +1,74 @@
+from ppla import PPLA
+
+
+def sink_writer(sink):
+    # Sockets have both send and sendall, only sendall guarantees that everything is written
+    for method in ['sendall', 'send', 'write']:
+        if hasattr(sink, method):
+            return getattr(sink, method)
+    if callable(sink):
+        return sink
+    raise ValueError('Sink must be a printer, file, socket or callable')
+
+
+class _SinkBuffer:
+    def __init__(self, write, buffer_size):
+        self._write = write
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self.bytes_written = 0
+
+    def __iadd__(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+        return self
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def flush(self):
+        if self._buffer:
+            self._write(bytes(self._buffer))
+            self.bytes_written += len(self._buffer)
+            self._buffer.clear()
+
+
+class PPLAStream(PPLA):
+    # Same commands as PPLA, but the data goes to a sink (Printer, file, socket or callable) as it is built.
+    # At most buffer_size bytes are held back, and everything is flushed at the end of each label. Nothing is kept
+    # per label, so a stream of any length runs in constant memory.
+
+    _keep_label_boundaries = False
+
+    def __init__(self, sink, buffer_size=64 * 1024):
+        super().__init__()
+        self._data = _SinkBuffer(sink_writer(sink), buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _data_size(self):
+        return self._data.bytes_written + len(self._data)
+
+    @property
+    def bytes_written(self):
+        return self._data.bytes_written
+
+    def flush(self):
+        self._data.flush()
+        return self
+
+    def label_end_job(self):
+        super().label_end_job()
+        return self.flush()
+
+    def get_bytes(self):
+        raise RuntimeError('PPLAStream sends its data to the sink, there are no bytes to get')
+
+    def get_label_boundaries(self):
+        raise RuntimeError('PPLAStream does not keep label boundaries, the data has already been sent')
@@ -0,0 +1,187 @@
+import re
+from ppla import PPLA
+from status import parse_memory_status
+
+_SLOT_TEXT_PATTERN = re.compile(r'\x00([^\x00]+)\x00')
+
+# A CR in a value would end the field record and start a new one from the rest of the value, e.g. a quantity
+_CONTROL_PATTERN = re.compile(rb'[\x00-\x1f\x7f]')
+
+
+def _encode_value(value):
+    if not isinstance(value, (bytes, bytearray)):
+        value = str(value).encode('ascii')
+    if _CONTROL_PATTERN.search(value):
+        raise ValueError('Control characters are not allowed in field values: {!r}'.format(value))
+    return value
+
+
+class CompiledTemplate:
+    def __init__(self, segments, slots):
+        # segments holds the static bytes around the slots, so it is always one longer than slots
+        self._parts = [None] * (2 * len(slots) + 1)
+        self._parts[0::2] = segments
+        self._slots = slots
+
+    @property
+    def slots(self):
+        return list(self._slots)
+
+    def render(self, record):
+        parts = list(self._parts)
+        parts[1::2] = [_encode_value(record[slot]) for slot in self._slots]
+        return b''.join(parts)
+
+    def render_many(self, records):
+        for record in records:
+            yield self.render(record)
+
+    def render_batch(self, records):
+        return b''.join(self.render_many(records))
+
+
+class LabelTemplate(PPLA):
+    # Builds a label like PPLA, but field data can be a named slot that is filled in per record when rendering
+
+    def __init__(self):
+        super().__init__()
+        # Data of every field record in order, the PPLA field numbers are the positions in this list plus one
+        self._fields = []
+        # (start, end, name) of every slot in _data, recorded as the fields are added, so other data such as binary
+        # graphics is never mistaken for a slot
+        self._slots = []
+
+    def _add_field(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            data = bytes(data).decode('ascii')
+        self._fields.append(data)
+        # The record just added ends with the field data and CR
+        data_offset = len(self._data) - 1 - len(data)
+        for match in _SLOT_TEXT_PATTERN.finditer(data):
+            self._slots.append((data_offset + match.start(), data_offset + match.end(), match.group(1)))
+
+    def label_text(self, x, y, data, *args, **kwargs):
+        super().label_text(x, y, data, *args, **kwargs)
+        self._add_field(data)
+        return self
+
+    def label_barcode(self, x, y, data, *args, **kwargs):
+        super().label_barcode(x, y, data, *args, **kwargs)
+        self._add_field(data)
+        return self
+
+    def label_box(self, *args, **kwargs):
+        super().label_box(*args, **kwargs)
+        self._add_field('')
+        return self
+
+    def label_line(self, *args, **kwargs):
+        super().label_line(*args, **kwargs)
+        self._add_field('')
+        return self
+
+    def label_graphic(self, x, y, name, *args, **kwargs):
+        super().label_graphic(x, y, name, *args, **kwargs)
+        self._add_field(name)
+        return self
+
+    def add_fields(self, fields):
+        # Go through the label_* methods, so every field record is tracked
+        for field in fields:
+            field = dict(field)
+            field_type = field.pop('type')
+            self._check_in_options(field_type, self._field_encoders)
+            getattr(self, 'label_' + field_type)(**field)
+        return self
+
+    def slot(self, name):
+        if not name or '\x00' in name:
+            raise ValueError('Invalid slot name')
+        return '\x00' + name + '\x00'
+
+    def compile(self):
+        data = bytes(self._data)
+        segments = []
+        offset = 0
+        for start, end, _ in self._slots:
+            segments.append(data[offset:start])
+            offset = end
+        segments.append(data[offset:])
+        return CompiledTemplate(segments, [name for _, _, name in self._slots])
+
+
+class StoredFormat(LabelTemplate):
+    # A label format that is downloaded to the printer once. Each label after that only sends the slot fields
+    # that changed since the previous label (STX U) and the quantity to print (STX E/G).
+    # Build the label body with the field methods, enter_label_mode and label_end_job are added by this class.
+
+    def __init__(self, name, memory='ram'):
+        super().__init__()
+        self._name = name
+        self._memory = memory
+        self._stored = False
+        self._last_values = {}
+        # Whether the next print asks the printer for its stored formats, and labels printed since it last did
+        self._verify_pending = False
+        self._labels_since_verify = 0
+
+    def _add_field(self, data):
+        super()._add_field(data)
+        if _SLOT_TEXT_PATTERN.search(self._fields[-1]):
+            self.label_make_previous_replaceable()
+
+    @property
+    def name(self):
+        return self._name
+
+    def field_numbers(self):
+        return {number: data for number, data in enumerate(self._fields, start=1) if _SLOT_TEXT_PATTERN.search(data)}
+
+    def _field_values(self, record):
+        return {number: _SLOT_TEXT_PATTERN.sub(lambda match: _encode_value(record[match.group(1)]).decode('ascii'), data)
+                for number, data in self.field_numbers().items()}
+
+    def store_bytes(self, record):
+        # Store the format filled with the first record, then recall it so STX U/G act on it
+        data = PPLA().enter_label_mode().get_bytes() + self.compile().render(record)
+        data += PPLA().label_store_format(self._name, memory=self._memory).label_terminate_without_printing().get_bytes()
+        data += PPLA().enter_label_mode().label_recall_format(self._name).label_terminate_without_printing().get_bytes()
+        self._stored = True
+        self._last_values = self._field_values(record)
+        return bytes(data)
+
+    def print_bytes(self, record, quantity=1):
+        if not self._stored:
+            return self.store_bytes(record) + self.print_bytes(record, quantity)
+        ppla = PPLA()
+        for number, value in self._field_values(record).items():
+            if self._last_values.get(number) != value:
+                ppla.replace_form_data(number, value)
+                self._last_values[number] = value
+        ppla.print_stored_label(quantity)
+        return bytes(ppla.get_bytes())
+
+    def invalidate(self):
+        self._stored = False
+        self._last_values = {}
+
+    def is_stored(self, printer):
+        printer.send(PPLA().inquire_label_memory_status().get_bytes())
+        return self._name.upper() in parse_memory_status(printer.recv(1024))['names']
+
+    def print(self, printer, record, quantity=1, verify=False, verify_every=None):
+        # Asking the printer for its stored formats costs a round trip, so it is done after a failed send, every
+        # verify_every labels and, with verify, before every label. A format found missing is stored again.
+        # After a soft reset call invalidate() to store the format again without asking.
+        self._labels_since_verify += 1
+        if self._stored and (verify or self._verify_pending
+                             or (verify_every is not None and self._labels_since_verify > verify_every)):
+            if not self.is_stored(printer):
+                self.invalidate()
+            self._verify_pending = False
+            self._labels_since_verify = 1
+        try:
+            return printer.send(self.print_bytes(record, quantity))
+        except Exception:
+            self._verify_pending = True
+            raise
@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+import usb.core
+from commands import parse_command
+from printer import TransferError, transfer_buffer
+from status import StatusMonitor
+
+
+class BackgroundWriter:
+    # Sends data to the printer from a separate thread, so the next label can be encoded while the previous one
+    # is transferred. send() blocks while max_queued chunks are waiting. A failed transfer drops the rest of the
+    # queue and is raised from the next send(), flush() or close().
+
+    def __init__(self, printer, max_queued=4):
+        self._printer = printer
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ppla-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                if self._error is None:
+                    self._printer.send(data)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Background write failed: {}'.format(self._error)) from self._error
+
+    def send(self, data):
+        self._check_error()
+        self.start()
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        self._queue.join()
+        self._check_error()
+
+    def _stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self._stop()
+        self._check_error()
+
+
+def label_boundaries(data):
+    # (start, end) offsets of the label blocks (STX L up to and including E) in PPLA data, for data that was not
+    # built with PPLA.get_label_boundaries at hand
+    boundaries = []
+    start = None
+    offset = 0
+    while offset < len(data):
+        parsed = parse_command(data, offset)
+        if parsed is None:
+            break
+        (prefix, payload), end = parsed
+        if prefix == 'STX' and payload == 'L':
+            start = offset
+        elif prefix == 'LINE' and payload == 'E' and start is not None:
+            boundaries.append((start, end))
+            start = None
+        offset = end
+    return boundaries
+
+
+class ResumableSender:
+    # Sends a job and, when a transfer stalls, resumes after the last label the printer received completely instead
+    # of sending the whole job again. After a failure it waits until the printer has printed what it received,
+    # soft resets it to drop the partly received label, waits until it is ready and sends the job's prologue
+    # (everything before the first label, e.g. settings and graphics) followed by the rest of the labels.
+    # Only whole writes are acknowledged, so chunk_size bounds the data in doubt when a write times out.
+
+    def __init__(self, printer, chunk_size=16 * 1024, max_attempts=3, poll_interval=0.5, max_wait=60.0):
+        self._printer = printer
+        self._chunk_size = chunk_size
+        self._max_attempts = max_attempts
+        self._monitor = StatusMonitor(printer, poll_interval=poll_interval, max_wait=max_wait)
+        self._poll_interval = poll_interval
+        self._max_wait = max_wait
+        self.resumes = 0
+        self.bytes_sent = 0
+
+    def _wait_printed(self):
+        start = time.monotonic()
+        while True:
+            try:
+                status = self._monitor.get_status()
+            except (RuntimeError, ValueError, usb.core.USBError):
+                # The printer may not answer until it is reconnected
+                self._printer.close()
+                self._printer.open()
+                status = self._monitor.get_status()
+            if not (status['busy_printing'] or status['printing_batch']):
+                return
+            if time.monotonic() - start > self._max_wait:
+                raise RuntimeError('Printer did not finish printing: {}'.format(status))
+            time.sleep(self._poll_interval)
+
+    def _recover(self):
+        self._wait_printed()
+        self._printer.soft_reset()
+        self._monitor.wait_until_ready()
+
+    def send(self, data, boundaries=None):
+        # boundaries are the (start, end) label offsets of PPLA.get_label_boundaries, found by parsing if not given
+        data = bytes(data)
+        if boundaries is None:
+            boundaries = label_boundaries(data)
+        label_ends = [end for _, end in boundaries]
+        prologue = data[:boundaries[0][0]] if boundaries else b''
+        resume_offset = 0
+        attempts = 0
+        while True:
+            payload = transfer_buffer(data if resume_offset == 0 else prologue + data[resume_offset:])
+            sent = 0
+            try:
+                while sent < len(payload):
+                    sent += self._printer.send(payload[sent:sent + self._chunk_size])
+                self.bytes_sent += sent
+                return len(data)
+            except TransferError as e:
+                sent += e.offset
+                self.bytes_sent += sent
+                attempts += 1
+                if attempts >= self._max_attempts:
+                    raise
+            acknowledged = sent if resume_offset == 0 else resume_offset + max(sent - len(prologue), 0)
+            resume_offset = max([resume_offset] + [end for end in label_ends if end <= acknowledged])
+            self.resumes += 1
+            self._recover()